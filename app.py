@@ -1,9 +1,13 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
 import streamlit as st
 import preprocessor
 import helper
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
+import chat_cache
+import chat_store
+import charts
+import jobs
+import profiling
 
 st.sidebar.title('WhatsApp Chat Analysis')
 col1, col2, col3, col4 = st.sidebar.columns([1, 2, 2, 1])
@@ -34,209 +38,392 @@ with st.expander('See!!.. How it works?'):
     st.markdown(
         '7. Repeat the steps for additional chats.')
 
-uploaded_file = st.sidebar.file_uploader("Choose a WhatsApp chat text file")
-if uploaded_file is not None:
-    # To read file as bytes:
-    bytes_data = uploaded_file.getvalue()
-    data = bytes_data.decode("utf-8")
-    df = preprocessor.preprocess(data)
+@st.cache_resource
+def get_chat_cache():
+    # One cache per server process, shared by every session
+    return chat_cache.ChatCache(int(os.environ.get('CHAT_CACHE_MB', 1024)) * 1024 * 1024)
+
+
+@st.cache_resource
+def get_chat_store():
+    # Optional server-side store of every analyzed chat, enabled by setting CHAT_STORE to a database path
+    path = os.environ.get('CHAT_STORE')
+    return chat_store.ChatStore(path) if path else None
+
+
+def load_chat(uploaded_file, chat_key):
+    # Parse the upload in chunks instead of decoding it into one big string. A newer export of a chat is parsed
+    # in full too: the sections need every message, so incremental updates are left to batch.py --incremental
+    uploaded_file.seek(0)
+    malformed = []
+    df = preprocessor.preprocess_file(uploaded_file, malformed=malformed)
+    store = get_chat_store()
+    if store is not None and not store.has_chat(chat_key):
+        store.add_chat(chat_key, df, uploaded_file.name)
+    return df, helper.ChatIndex(df), malformed
+
+
+@st.cache_resource
+def get_job_manager():
+    # One pool of analysis jobs per server process, shared by every session
+    return jobs.JobManager()
+
+
+# The expensive sections of the analysis compute their data and render their charts in background jobs.
+# Jobs never call Streamlit; the page draws each section once its job is done.
+
+def patterns_section(chat_key, selected_user, df, index):
+    pattern_results = helper.analyze_message_patterns(df, selected_user, index)
+    chart_data = {
+        'timing': pattern_results['timing_patterns'],
+        'sentiment': pattern_results['sentiment_stats']
+    }
+    if pattern_results['topic_clusters']:
+        chart_data['topics'] = pattern_results['topic_clusters']
+    if len(pattern_results['user_interactions']) > 0:
+        chart_data['interactions'] = pattern_results['user_interactions']
+        # Reply probabilities only make sense over the whole chat, whichever member is selected
+        chart_data['reply_matrix'] = helper.reply_probabilities(index.transitions)
+    return {'results': pattern_results, 'images': charts.render_charts(chat_key, selected_user, chart_data)}
+
+
+def activity_section(chat_key, selected_user, df, index):
+    chart_data = {
+        'timeline': helper.monthly_timeline(selected_user, df, index),
+        'busy_day': helper.week_activity_map(selected_user, df, index),
+        'busy_month': helper.month_activity_map(selected_user, df, index)
+    }
+    user_heatmap = helper.activity_heatmap(selected_user, df, index)
+    if not user_heatmap.empty:
+        chart_data['heatmap'] = user_heatmap
+
+    # Finding the busiest users in the group (Group level)
+    new_df = None
+    if selected_user == 'Overall':
+        x, new_df = helper.most_busy_users(df)
+        chart_data['busy_users'] = x
+    return {'busy_users': new_df, 'images': charts.render_charts(chat_key, selected_user, chart_data)}
+
+
+def wordcloud_image(selected_user, df, index):
+    # None when the member wrote no words to draw
+    wordcloud = helper.create_wordcloud(selected_user, df, index)
+    return wordcloud.to_array() if wordcloud is not None else None
+
+
+def words_section(chat_key, selected_user, df, index):
+    chart_data = {
+        # The wordcloud is only generated when its image is not cached yet
+        'wordcloud': lambda: wordcloud_image(selected_user, df, index),
+        'common_words': helper.most_common_words(selected_user, df, index)
+    }
+    return {'images': charts.render_charts(chat_key, selected_user, chart_data)}
+
+
+def emoji_section(chat_key, selected_user, df, index):
+    emoji_df = helper.emoji_helper(selected_user, df, index)
+    return {'emoji_df': emoji_df, 'images': charts.render_charts(chat_key, selected_user, {'emoji': emoji_df})}
+
+
+def responses_section(chat_key, selected_user, df, index):
+    # Response Patterns
+    response_patterns = helper.get_response_patterns(df)
+
+    # Peak Activity Hours
+    peak_hours = helper.get_peak_activity_hours(selected_user, df, index)
+    chart_data = {'peak_hours': peak_hours} if not peak_hours.empty else {}
+    return {'response_patterns': response_patterns,
+            'images': charts.render_charts(chat_key, selected_user, chart_data)}
+
+
+sections = {
+    'patterns': ('Message patterns', patterns_section),
+    'activity': ('Activity', activity_section),
+    'words': ('Words', words_section),
+    'emoji': ('Emojis', emoji_section),
+    'responses': ('Advanced analytics', responses_section)
+}
+
+
+def submit_analysis(chat_key, selected_user, df, index, profile=None):
+    """Start the jobs of every section for this chat and user, giving up the previous selection's jobs.
+
+    Jobs of a selection that is no longer shown are cancelled unless they
+    already run or another session waits for the same ones. ``profile``
+    holds the profiling settings, so a profiled run never reuses jobs that
+    ran without recording their stages.
+    """
+    manager = get_job_manager()
+    key = (chat_key, selected_user, profile)
+    current = st.session_state.get('analysis_jobs')
+    if current is not None and current['key'] == key:
+        return current['futures']
+    if current is not None:
+        for section in current['futures']:
+            manager.release(current['key'] + (section,))
+
+    futures = {section: manager.submit(key + (section,), function, chat_key, selected_user, df, index)
+               for section, (_, function) in sections.items()}
+    st.session_state['analysis_jobs'] = {'key': key, 'futures': futures}
+    return futures
+
+
+def show_patterns_summary(section, selected_user):
+    pattern_results, images = section['results'], section['images']
+
+    # Display basic statistics
+    st.subheader("Message Pattern Statistics")
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.metric("Average Message Length",
+                  f"{pattern_results['avg_message_length']:.1f} characters")
+    with col2:
+        st.metric("Average Words per Message",
+                  f"{pattern_results['avg_words_per_message']:.1f} words")
+
+    # Show timing distribution
+    st.subheader("Message Timing Patterns")
+    st.image(images['timing'])
+
+    # Show what the messages are about, one bar per topic cluster
+    if 'topics' in images:
+        st.subheader("Message Topics")
+        st.image(images['topics'])
+
+
+def show_activity(section, selected_user):
+    images = section['images']
+
+    # Monthly timeline
+    st.title("Monthly Timeline")
+    st.image(images['timeline'])
+
+    # Activity map
+    st.title('Activity Map')
+    col1, col2 = st.columns(2)
 
-    # Fetch unique users
-    user_list = df['user'].unique().tolist()
-    if 'group_notification' in user_list:
-        user_list.remove('group_notification')
-    user_list.sort()
-    user_list.insert(0, "Overall")
+    with col1:
+        st.header("Most Busy Day")
+        st.image(images['busy_day'])
+
+    with col2:
+        st.header("Most Busy Month")
+        st.image(images['busy_month'])
+
+    # Weekly Activity Map
+    st.title("Weekly Activity Map")
+
+    # Check if user_heatmap is empty
+    if 'heatmap' not in images:
+        st.warning("No activity data available for the selected user.")
+    else:
+        st.image(images['heatmap'])
+
+    # Finding the busiest users in the group (Group level)
+    if selected_user == 'Overall':
+        st.title('Most Busy Users')
+        col1, col2 = st.columns(2)
 
-    selected_user = st.sidebar.selectbox("Show analysis wrt", user_list)
+        with col1:
+            st.image(images['busy_users'])
+        with col2:
+            st.dataframe(section['busy_users'])
 
-    if st.sidebar.button("Show Analysis"):
-        # Fetch all statistics
-        stats = helper.fetch_stats(selected_user, df)
 
-        # Display Title
-        st.title("Chat Statistics")
+def show_words(section, selected_user):
+    # WordCloud
+    st.title("Wordcloud")
+    if 'wordcloud' in section['images']:
+        st.image(section['images']['wordcloud'])
+    else:
+        st.info("No words to draw a wordcloud from.")
 
-        # Display date range and total members
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            st.metric("Chat From", stats['chat_from'])
-        with col2:
-            st.metric("Chat To", stats['chat_to'])
-        with col3:
-            st.metric("Total Members", stats['total_members'])
+    # Most common words
+    st.title("Most Common Words")
+    st.image(section['images']['common_words'])
 
-        # Display message statistics
-        col1, col2, col3, col4, col5 = st.columns(5)
-        with col1:
-            st.metric("Total Messages", stats['num_messages'])
-        with col2:
-            st.metric("Total Words", stats['num_words'])
-        with col3:
-            st.metric("Media Shared", stats['num_media'])
-        with col4:
-            st.metric("Links Shared", stats['num_links'])
-        with col5:
-            st.metric("Missed Calls", stats['missed_calls'])
-            # bar plot of user activity
-        with st.expander("Which members are the most active in the chat?...click '+' to see details"):
-            st.markdown(
-                'The graph shows the activity level of all members in the chat, represented by a bar chart. '
-                'The longest bar represents the highest level of contribution in the chat, and the names of '
-                'the members are listed on the X-axis. The second graph illustrates the average number of messages '
-                'among all members and shows how much a member\'s activity is above or below the average.')
-
-        user_count = df['user'].value_counts()
-        st.bar_chart(user_count)
-
-    # with st.expander("Message Pattern Analysis", expanded=False):
-    
-        # Get pattern analysis results
-        pattern_results = helper.analyze_message_patterns(df, selected_user)
-
-        # Display basic statistics
-        st.subheader("Message Pattern Statistics")
-        col1, col2 = st.columns(2)
 
-        with col1:
-            st.metric("Average Message Length",
-                      f"{pattern_results['avg_message_length']:.1f} characters")
-        with col2:
-            st.metric("Average Words per Message",
-                      f"{pattern_results['avg_words_per_message']:.1f} words")
-
-        # Display visualizations
-        # st.subheader("Pattern Visualizations")
-        figs = helper.create_pattern_visualizations(pattern_results, df)
-
-        # Show timing distribution
-        if 'timing' in figs:
-            st.subheader("Message Timing Patterns")
-            st.pyplot(figs['timing'])
-        # Monthly timeline
-        st.title("Monthly Timeline")
-        timeline = helper.monthly_timeline(selected_user, df)
-        fig, ax = plt.subplots()
-        ax.plot(timeline['time'], timeline['message'], color='green', marker="o")
-        plt.xticks(rotation='vertical')
-        st.pyplot(fig)
-
-        # Activity map
-        st.title('Activity Map')
-        col1, col2 = st.columns(2)
+def show_emoji(section, selected_user):
+    # Emoji analysis
+    st.title("Emoji Analysis")
 
-        with col1:
-            st.header("Most Busy Day")
-            busy_day = helper.week_activity_map(selected_user, df)
-            fig, ax = plt.subplots()
-            ax.bar(busy_day.index, busy_day.values, color='purple')
-            plt.xticks(rotation='vertical')
-            st.pyplot(fig)
+    col1, col2 = st.columns(2)
 
-        with col2:
-            st.header("Most Busy Month")
-            busy_month = helper.month_activity_map(selected_user, df)
-            fig, ax = plt.subplots()
-            ax.bar(busy_month.index, busy_month.values, color='orange')
-            plt.xticks(rotation='vertical')
-            st.pyplot(fig)
-
-        # Weekly Activity Map
-        st.title("Weekly Activity Map")
-        user_heatmap = helper.activity_heatmap(selected_user, df)
-
-        # Check if user_heatmap is empty
-        if user_heatmap.empty:
-            st.warning("No activity data available for the selected user.")
-        else:
-            fig, ax = plt.subplots()
-            ax = sns.heatmap(user_heatmap, cmap='Blues', annot=True, fmt='.0f')
-            plt.title('Activity Heatmap')
-            plt.xlabel('Hour of Day')
-            plt.ylabel('Day of Week')
-            st.pyplot(fig)
-
-        # Finding the busiest users in the group (Group level)
-        if selected_user == 'Overall':
-            st.title('Most Busy Users')
-            x, new_df = helper.most_busy_users(df)
-
-            # Ensure x is a DataFrame or Series
-            if isinstance(x, (pd.Series, pd.DataFrame)):
-                fig, ax = plt.subplots()
-                col1, col2 = st.columns(2)
-
-                with col1:
-                    fig, ax = plt.subplots(figsize=(10, 11))  # Set a specific figure size
-                    sns.barplot(x=x.index, y=x.values, palette="viridis")  # Seaborn bar plot
-                    ax.set(xlabel=None)
-                    st.pyplot(fig)
-                with col2:
-                    st.dataframe(new_df)
-            else:
-                st.error("Error: Unable to retrieve busy users data.")
-
-        # WordCloud
-        st.title("Wordcloud")
-        df_wc = helper.create_wordcloud(selected_user, df)  # Ensure this function exists in helper.py
-        fig, ax = plt.subplots()
-        ax.imshow(df_wc, interpolation='bilinear')  # Use interpolation for better display
-        ax.axis('off')  # Hide axes
-        st.pyplot(fig)
-
-        # Most common words
-        st.title("Most Common Words")
-        most_common_df = helper.most_common_words(selected_user, df)
-        fig, ax = plt.subplots(figsize=(10, 6))  # Set a specific figure size
-        sns.barplot(x='Frequency', y='Word', data=most_common_df, palette="rocket",
-                    ax=ax)  # Seaborn horizontal bar plot
-
-        # Display plot in Streamlit
-        st.pyplot(fig)
-
-        # Emoji analysis
-        emoji_df = helper.emoji_helper(selected_user, df)
-        st.title("Emoji Analysis")
+    with col1:
+        st.dataframe(section['emoji_df'])
+    with col2:
+        st.image(section['images']['emoji'])
 
-        col1, col2 = st.columns(2)
 
-        with col1:
-            st.dataframe(emoji_df)
-        with col2:
-            fig, ax = plt.subplots()
-            ax.pie(emoji_df['Count'].head(), labels=emoji_df['Emoji'].head(), autopct="%0.2f")  # Access columns by name
-            st.pyplot(fig)
-
-        try:
-            # Response Patterns
-            response_patterns = helper.get_response_patterns(df)
-            if not response_patterns.empty:
-                st.subheader("Response Patterns Analysis")
-                avg_response_times = response_patterns.groupby(['from_user', 'to_user'])['response_time'].mean()
-                st.dataframe(avg_response_times.reset_index())
-
-            # Peak Activity Hours
-            peak_hours = helper.get_peak_activity_hours(selected_user, df)
-            if not peak_hours.empty:
-                st.subheader("Peak Activity Hours")
-                fig, ax = plt.subplots()
-                peak_hours.plot(kind='bar', ax=ax)
-                plt.title('Peak Activity Hours')
-                plt.xlabel('Hour of Day')
-                plt.ylabel('Number of Messages')
-                st.pyplot(fig)
-        except Exception as e:
-            st.error(f"Error in advanced analytics: {str(e)}")
-
-        # Show sentiment distribution
-        if 'sentiment' in figs:
-            st.subheader("Message Sentiment Distribution")
-            st.pyplot(figs['sentiment'])
-
-        # Show user interactions
-        if 'interactions' in figs:
-            st.subheader("Top User Interactions")
-            st.pyplot(figs['interactions'])
+def show_responses(section, selected_user):
+    if not section['response_patterns'].empty:
+        st.subheader("Response Patterns Analysis")
+        st.dataframe(section['response_patterns'])
+
+    if 'peak_hours' in section['images']:
+        st.subheader("Peak Activity Hours")
+        st.image(section['images']['peak_hours'])
+
+
+def show_patterns_details(section, selected_user):
+    images = section['images']
 
+    # Show sentiment distribution
+    st.subheader("Message Sentiment Distribution")
+    st.image(images['sentiment'])
 
+    # Show user interactions
+    if 'interactions' in images:
+        st.subheader("Top User Interactions")
+        st.image(images['interactions'])
 
+        st.subheader("Who Replies to Whom")
+        st.caption("Share of the replies to each member's messages that came from every other member.")
+        st.image(images['reply_matrix'])
+
+
+uploaded_file = st.sidebar.file_uploader("Choose a WhatsApp chat text file")
+
+with st.sidebar.expander('Performance profiling'):
+    profile_run = st.checkbox('Time each analysis stage')
+    profile_memory = st.checkbox('Track peak memory (slower)', disabled=not profile_run)
+    profile_calls = st.checkbox('Capture cProfile (slower)', disabled=not profile_run)
+
+if uploaded_file is not None:
+    # Time the stages of this run only when asked; otherwise instrumented functions run untouched
+    profiler = profiling.activate(
+        profiling.Profiler(memory=profile_memory, cprofile=profile_calls) if profile_run else None)
+    try:
+
+        # Reuse the parsed chat across reruns, keyed by the upload's content
+        chat_key = chat_cache.content_hash(uploaded_file.getbuffer())
+        df, index, malformed = get_chat_cache().get_or_load(chat_key, lambda: load_chat(uploaded_file, chat_key))
+
+        # Tell the uploader about lines that looked like messages but whose timestamp isn't a valid date
+        if malformed:
+            st.warning(f"{len(malformed)} messages were skipped because their timestamp could not be read.")
+            with st.expander('Skipped messages'):
+                st.dataframe([{'Timestamp': date, 'User': user, 'Message': message}
+                              for date, user, message in malformed[:1000]])
+
+        # Fetch unique users
+        user_list = df['user'].unique().tolist()
+        if 'group_notification' in user_list:
+            user_list.remove('group_notification')
+        user_list.sort()
+        user_list.insert(0, "Overall")
+
+        selected_user = st.sidebar.selectbox("Show analysis wrt", user_list)
+
+        # Start the expensive sections straight away, so they are under way before "Show Analysis" is clicked
+        futures = submit_analysis(chat_key, selected_user, df, index,
+                                  (profile_memory, profile_calls) if profile_run else None)
+
+        if st.sidebar.button("Show Analysis"):
+            # Fetch all statistics
+            stats = helper.fetch_stats(selected_user, df, index)
+
+            # Display Title
+            st.title("Chat Statistics")
+
+            # Display date range and total members
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Chat From", stats['chat_from'])
+            with col2:
+                st.metric("Chat To", stats['chat_to'])
+            with col3:
+                st.metric("Total Members", stats['total_members'])
+
+            # Display message statistics
+            col1, col2, col3, col4, col5 = st.columns(5)
+            with col1:
+                st.metric("Total Messages", stats['num_messages'])
+            with col2:
+                st.metric("Total Words", stats['num_words'])
+            with col3:
+                st.metric("Media Shared", stats['num_media'])
+            with col4:
+                st.metric("Links Shared", stats['num_links'])
+            with col5:
+                st.metric("Missed Calls", stats['missed_calls'])
+                # bar plot of user activity
+            with st.expander("Which members are the most active in the chat?...click '+' to see details"):
+                st.markdown(
+                    'The graph shows the activity level of all members in the chat, represented by a bar chart. '
+                    'The longest bar represents the highest level of contribution in the chat, and the names of '
+                    'the members are listed on the X-axis. The second graph illustrates the average number of messages '
+                    'among all members and shows how much a member\'s activity is above or below the average.')
+
+            user_count = df['user'].value_counts()
+            st.bar_chart(user_count)
+
+            # Every section gets its place on the page now and is drawn there as soon as its job is done
+            progress = st.progress(0.0, text="Analyzing...")
+            views = {section: [] for section in sections}
+            for section, show in [('patterns', show_patterns_summary), ('activity', show_activity),
+                                  ('words', show_words), ('emoji', show_emoji)]:
+                views[section].append((st.empty(), show))
+
+            session_summary, participation = helper.get_session_stats(df, index)
+            # Conversations end after helper.session_gap minutes without messages
+            st.title("Conversations")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Conversations", session_summary['num_sessions'])
+            with col2:
+                st.metric("Messages per Conversation", f"{session_summary['avg_messages']:.1f}")
+            with col3:
+                st.metric("Median Length", f"{session_summary['median_minutes']:.0f} minutes")
+            if selected_user != 'Overall':
+                participation = participation[participation['Member'] == selected_user]
+            st.dataframe(participation)
+
+            for section, show in [('responses', show_responses), ('patterns', show_patterns_details)]:
+                views[section].append((st.empty(), show))
+
+            for section, placeholders in views.items():
+                for placeholder, _ in placeholders:
+                    placeholder.info(f"{sections[section][0]}: working on it...")
+
+            pending = set(futures.values())
+            while pending:
+                # Waking up regularly lets Streamlit stop this run as soon as the selection changes
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for section, future in futures.items():
+                    if future not in done:
+                        continue
+                    error = future.exception()
+                    # Stages of the job were recorded apart from this run's; they count once the section is shown
+                    if profiler is not None and future.recorder is not None:
+                        profiler.merge(future.recorder)
+                    for i, (placeholder, show) in enumerate(views[section]):
+                        with placeholder.container():
+                            if error is None:
+                                show(future.result(), selected_user)
+                            elif i == 0:
+                                st.error(f"Error in {sections[section][0].lower()}: {str(error)}")
+
+                ready = [sections[section][0] for section, future in futures.items() if future.done()]
+                progress.progress(len(ready) / len(futures),
+                                  text=f"{len(ready)} of {len(futures)} sections ready: {', '.join(ready)}")
+            progress.empty()
+            # The sections filled the lazily computed parts of the index, which count towards the cache budget
+            get_chat_cache().refresh(chat_key)
+    finally:
+        # Streamlit stops a run by raising inside it; the profiler, and any tracemalloc it started, must stop too
+        if profiler is not None:
+            profiler.stop()
+
+    if profiler is not None:
+        with st.expander('Performance'):
+            st.caption(f"Whole run: {profiler.total_seconds:.3f}s. Stages run inside other stages are "
+                       "counted in both; a chat loaded from the cache has no parsing stages.")
+            st.dataframe(profiler.summary())
+            st.dataframe(profiler.to_frame())
+            if profile_calls:
+                # The capture covers this run's own thread; the sections' jobs only report their stages
+                st.code(profiler.cprofile_stats() or "No cProfile capture: another run was capturing one.")
+            st.download_button('Download as JSON', profiler.to_json(), file_name='profile.json',
+                               mime='application/json')
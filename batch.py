@@ -0,0 +1,234 @@
+"""Analyze many WhatsApp chat exports without the Streamlit app.
+
+Usage:
+    python batch.py EXPORTS_DIR_OR_GLOB [...] -o OUTPUT_DIR [--workers N] [--parquet] [--store DB | --incremental]
+
+Every export gets a JSON summary in the output directory. A manifest there
+records the outcome and timing of each file, so running the same command
+again after a crash only processes the files that are not done yet.
+With --incremental the aggregates of every chat are kept in the output
+directory, and a newer export of a chat only parses the messages added
+since the last one.
+"""
+import argparse
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import chat_store
+import helper
+import incremental
+import preprocessor
+
+manifest_name = 'manifest.json'
+
+# Subdirectory of the output directory holding the aggregates of --incremental runs
+history_dir_name = 'history'
+
+
+def find_exports(inputs):
+    """Expand directories and glob patterns into a sorted list of .txt files"""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.update(glob.glob(os.path.join(item, '**', '*.txt'), recursive=True))
+        else:
+            paths.update(path for path in glob.glob(item, recursive=True) if os.path.isfile(path))
+    return sorted(os.path.abspath(path) for path in paths)
+
+
+def _to_json(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, (pd.Timestamp, pd.Timedelta)):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _write_atomic(path, text):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def summarize_chat(df, index):
+    """Statistics of a parsed chat, overall and for every user"""
+    users = sorted(user for user in df['user'].unique() if user != 'group_notification')
+    timeline = helper.monthly_timeline('Overall', df, index)
+    busy_users = helper.most_busy_users(df)[1]
+
+    return {
+        'stats': {user: helper.fetch_stats(user, df, index) for user in ['Overall'] + users},
+        'monthly_timeline': dict(zip(timeline['time'], timeline['message'])),
+        'busy_users': dict(zip(busy_users['user'].astype(str), busy_users['num_messages'])),
+        'week_activity': helper.week_activity_map('Overall', df, index).to_dict(),
+        'peak_hours': helper.get_peak_activity_hours('Overall', df, index).to_dict(),
+        'most_common_words': helper.most_common_words('Overall', df, index).values.tolist(),
+        'emojis': helper.emoji_helper('Overall', df, index).values.tolist(),
+        'response_patterns': helper.get_response_patterns(df).to_dict(orient='records')
+    }
+
+
+def summarize_history(history):
+    """Statistics of a chat answered from its incremental aggregates, in the shape of summarize_chat.
+
+    Response patterns need every message and are left out.
+    """
+    users = sorted(user for user in history.user_stats.index if user != 'group_notification')
+    timeline = helper.monthly_timeline('Overall', None, history)
+    # Ties keep the order in which users first wrote, like most_busy_users
+    busy_users = history.user_stats.sort_values(['messages', 'first_date'], ascending=[False, True])['messages']
+
+    return {
+        'stats': {user: history.fetch_stats(user) for user in ['Overall'] + users},
+        'monthly_timeline': dict(zip(timeline['time'], timeline['message'])),
+        'busy_users': busy_users.to_dict(),
+        'week_activity': helper.week_activity_map('Overall', None, history).to_dict(),
+        'peak_hours': helper.get_peak_activity_hours('Overall', None, history).to_dict(),
+        'most_common_words': helper.most_common_words('Overall', None, history).values.tolist(),
+        'emojis': helper.emoji_helper('Overall', None, history).values.tolist()
+    }
+
+
+def output_name(path):
+    """Name for a file's outputs, unique even when exports in different folders share a name"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{stem}-{hashlib.blake2b(path.encode('utf-8'), digest_size=4).hexdigest()}"
+
+
+def analyze_file(path, out_dir, parquet=False, store=None, incremental_history=False):
+    """Parse and summarize one export, writing its outputs; runs in a worker process.
+
+    With ``store`` (a database path) the parsed chat is also saved in a
+    ChatStore under its output name. With ``incremental_history`` the export
+    is merged into the stored aggregates of its chat, parsing only what is
+    new, and summarized from them.
+    """
+    started = time.perf_counter()
+    if incremental_history:
+        with open(path, encoding='utf-8') as f:
+            # This already runs in one of the batch's worker processes, so sentiment is scored in it
+            history, df = incremental.update_history(f.read(), os.path.join(out_dir, history_dir_name), processes=1)
+        parsed = time.perf_counter()
+        messages = history.messages
+        summary = summarize_history(history)
+    else:
+        with open(path, 'rb') as f:
+            df = preprocessor.preprocess_file(f)
+        parsed = time.perf_counter()
+        messages = len(df)
+        summary = summarize_chat(df, helper.ChatIndex(df))
+    summary['file'] = path
+    summary['timing'] = {
+        'preprocess_seconds': parsed - started,
+        'analysis_seconds': time.perf_counter() - parsed
+    }
+
+    name = output_name(path)
+    if store:
+        stored = chat_store.ChatStore(store, pool_size=1)
+        try:
+            stored.add_chat(name, df, os.path.basename(path))
+        finally:
+            stored.close()
+    _write_atomic(os.path.join(out_dir, name + '.json'), json.dumps(summary, indent=2, default=_to_json))
+    if parquet:
+        stats = pd.DataFrame.from_dict(summary['stats'], orient='index').rename_axis('user').reset_index()
+        stats.to_parquet(os.path.join(out_dir, name + '.stats.parquet'), index=False)
+
+    return {'output': name, 'messages': messages, 'new_messages': len(df),
+            'seconds': time.perf_counter() - started}
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, manifest_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+    _write_atomic(os.path.join(out_dir, manifest_name), json.dumps(manifest, indent=2, default=_to_json))
+
+
+def run_batch(paths, out_dir, workers=None, parquet=False, store=None, incremental_history=False):
+    """Analyze exports on a process pool, skipping files the manifest marks as done.
+
+    A failing file is recorded in the manifest with its error and does not
+    stop the others. Returns the manifest.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+
+    pending = []
+    for path in paths:
+        entry = manifest.get(path)
+        if entry and entry['status'] == 'done' and entry['source'] == _fingerprint(path):
+            continue
+        pending.append(path)
+    print(f"{len(paths) - len(pending)} of {len(paths)} exports already done, processing {len(pending)}")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_file, path, out_dir, parquet, store, incremental_history): path
+                   for path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            entry = {'source': _fingerprint(path)}
+            try:
+                entry.update(future.result(), status='done')
+                print(f"Done {path}: {entry['messages']} messages in {entry['seconds']:.2f}s")
+            except Exception as e:
+                entry.update(status='failed', error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+                print(f"Failed {path}: {entry['error']}")
+            manifest[path] = entry
+            save_manifest(out_dir, manifest)
+
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze WhatsApp chat exports in batch.')
+    parser.add_argument('inputs', nargs='+', help='directories or glob patterns of .txt exports')
+    parser.add_argument('-o', '--output', required=True, help='directory for summaries and the manifest')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--parquet', action='store_true', help='also write per-user statistics as Parquet')
+    parser.add_argument('--store', help='also load every chat into this SQLite chat store')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep per-chat aggregates and only parse what newer exports add')
+    args = parser.parse_args(argv)
+    if args.parquet and importlib.util.find_spec('pyarrow') is None:
+        parser.error('--parquet needs pyarrow (pip install -r requirements.txt)')
+    if args.store and args.incremental:
+        # The store keeps every message, which an incremental run doesn't parse
+        parser.error('--store and --incremental cannot be combined')
+
+    paths = find_exports(args.inputs)
+    if not paths:
+        parser.error('no .txt exports found')
+
+    manifest = run_batch(paths, args.output, args.workers, args.parquet, args.store, args.incremental)
+    failed = [path for path in paths if manifest[path]['status'] == 'failed']
+    print(f"Finished: {len(paths) - len(failed)} done, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
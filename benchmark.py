@@ -0,0 +1,163 @@
+"""Time and memory-profile the analysis stages on synthetic exports.
+
+Usage:
+    python benchmark.py --lines 10000 100000 -o results.json [--baseline baseline.json]
+
+Results are written as JSON. With --baseline, every stage is compared with
+the stored run and the exit code is 1 if any stage got slower than the
+allowed ratio.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+import helper
+import preprocessor
+import sentiment
+import synthetic
+
+# Stage name and the call that runs it, given the parsed frame and its index
+stages = [
+    ('build_index', lambda df, index: helper.ChatIndex(df)),
+    ('fetch_stats', lambda df, index: helper.fetch_stats('Overall', df)),
+    ('monthly_timeline', lambda df, index: helper.monthly_timeline('Overall', df)),
+    ('week_activity_map', lambda df, index: helper.week_activity_map('Overall', df)),
+    ('activity_heatmap', lambda df, index: helper.activity_heatmap('Overall', df)),
+    ('most_common_words', lambda df, index: helper.most_common_words('Overall', df)),
+    ('emoji_helper', lambda df, index: helper.emoji_helper('Overall', df)),
+    ('get_chat_patterns', lambda df, index: helper.get_chat_patterns(df)),
+    ('get_session_stats', lambda df, index: helper.get_session_stats(df)),
+    ('transition_matrix', lambda df, index: helper.transition_matrix(df['user'])),
+    ('get_response_patterns', lambda df, index: helper.get_response_patterns(df)),
+    ('cluster_messages', lambda df, index: helper.cluster_messages(df['message'])),
+    ('message_features', lambda df, index: helper.message_features(df)),
+    ('analyze_message_patterns', lambda df, index: helper.analyze_message_patterns(df, 'Overall')),
+    ('create_wordcloud', lambda df, index: helper.create_wordcloud('Overall', df, index)),
+    ('indexed_user_lookup', lambda df, index: [
+        helper.fetch_stats(user, df, index) for user in index.user_rows]),
+]
+
+
+def measure(function, *args, memory=True):
+    """Run function once, returning its result, wall time and peak traced memory in bytes"""
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = function(*args)
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run(line_counts, fmt='mixed', memory=True, only=None, **options):
+    """Benchmark every stage for each export size and return the result records"""
+    records = []
+    for num_lines in line_counts:
+        data = synthetic.generate_chat(num_lines, fmt=fmt, **options)
+
+        df, seconds, peak = measure(preprocessor.preprocess, data, memory=memory)
+        records.append({'lines': num_lines, 'stage': 'preprocess', 'rows': len(df),
+                        'seconds': seconds, 'peak_bytes': peak})
+        print(f"{num_lines:>10} lines  {'preprocess':<26} {seconds:9.3f}s")
+
+        index = helper.ChatIndex(df)
+        for name, stage in stages:
+            if only and name not in only:
+                continue
+            _, seconds, peak = measure(stage, df, index, memory=memory)
+            records.append({'lines': num_lines, 'stage': name, 'rows': len(df),
+                            'seconds': seconds, 'peak_bytes': peak})
+            print(f"{num_lines:>10} lines  {name:<26} {seconds:9.3f}s")
+    return records
+
+
+def compare(records, baseline, max_ratio):
+    """Print each stage's time relative to the baseline and return the stages that regressed"""
+    previous = {(record['lines'], record['stage']): record['seconds'] for record in baseline['results']}
+    regressions = []
+    for record in records:
+        key = (record['lines'], record['stage'])
+        if key not in previous or not previous[key]:
+            continue
+        ratio = record['seconds'] / previous[key]
+        flag = '  REGRESSION' if ratio > max_ratio else ''
+        print(f"{record['lines']:>10} lines  {record['stage']:<26} {ratio:6.2f}x baseline{flag}")
+        if flag:
+            regressions.append(record['stage'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the WhatsApp chat analysis stages.')
+    parser.add_argument('--lines', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--format', default='mixed', choices=list(preprocessor.patterns) + ['mixed'])
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--multiline-ratio', type=float, default=0.1)
+    parser.add_argument('--media-ratio', type=float, default=0.05)
+    parser.add_argument('--url-ratio', type=float, default=0.05)
+    parser.add_argument('--emoji-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stage', action='append', help='only run these stages (preprocess always runs)')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows stages down')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--max-ratio', type=float, default=1.25,
+                        help='slowdown relative to the baseline reported as a regression')
+    args = parser.parse_args(argv)
+
+    options = {'users': args.users, 'multiline_ratio': args.multiline_ratio, 'media_ratio': args.media_ratio,
+               'url_ratio': args.url_ratio, 'emoji_ratio': args.emoji_ratio, 'seed': args.seed}
+    memory = not args.no_memory
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        # tracemalloc slows stages down several times, so traced and untraced timings can't be compared
+        if baseline['meta'].get('memory') != memory:
+            parser.error(f"{args.baseline} was not run with the same memory tracking "
+                         f"({'--no-memory' if memory else 'without --no-memory'} there)")
+        for option, value in dict(options, format=args.format).items():
+            if baseline['meta'].get(option, value) != value:
+                print(f"Warning: the baseline used {option}={baseline['meta'][option]}, this run {value}")
+
+    # Scores cached by an earlier run would hide the cost of sentiment analysis
+    sentiment.cache_path = None
+
+    records = run(args.lines, fmt=args.format, memory=memory, only=args.stage, **options)
+    results = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'format': args.format,
+            'memory': memory,
+            **options
+        },
+        'results': records
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(records, baseline, args.max_ratio)
+        if regressions:
+            print(f"{len(regressions)} stages regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+from matplotlib.figure import Figure
+import pandas as pd
+import seaborn as sns
+
+import chat_cache
+import profiling
+
+# Worker processes used to render charts; 1 renders in the calling process
+render_processes = min(4, os.cpu_count() or 1)
+
+# Memory budget of the rendered image cache
+image_cache_bytes = 256 * 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+_image_cache = chat_cache.ChatCache(image_cache_bytes)
+
+
+def _subplots(figsize=None):
+    # Figures are built without pyplot, whose figure registry is global, so charts of several analysis
+    # jobs can be rendered in their threads at once
+    fig = Figure(figsize=figsize)
+    return fig, fig.subplots()
+
+
+# Each chart is a pure function from aggregate data to a matplotlib figure
+
+def timing_chart(timing_patterns):
+    fig, ax = _subplots(figsize=(10, 6))
+    pd.Series(timing_patterns).plot(kind='bar', ax=ax)
+    ax.set_title('Message Distribution by Time of Day')
+    ax.set_ylabel('Number of Messages')
+    return fig
+
+
+def topics_chart(topic_clusters):
+    fig, ax = _subplots(figsize=(10, 6))
+    topics = pd.Series(topic_clusters)
+    sns.barplot(x=topics.values, y=topics.index, palette="mako", ax=ax)
+    ax.set_title('Message Topics')
+    ax.set_xlabel('Number of Messages')
+    return fig
+
+
+def timeline_chart(timeline):
+    fig, ax = _subplots()
+    ax.plot(timeline['time'], timeline['message'], color='green', marker="o")
+    ax.tick_params(axis='x', labelrotation=90)
+    return fig
+
+
+def busy_day_chart(busy_day):
+    fig, ax = _subplots()
+    ax.bar(busy_day.index, busy_day.values, color='purple')
+    ax.tick_params(axis='x', labelrotation=90)
+    return fig
+
+
+def busy_month_chart(busy_month):
+    fig, ax = _subplots()
+    ax.bar(busy_month.index, busy_month.values, color='orange')
+    ax.tick_params(axis='x', labelrotation=90)
+    return fig
+
+
+def heatmap_chart(user_heatmap):
+    fig, ax = _subplots()
+    sns.heatmap(user_heatmap, cmap='Blues', annot=True, fmt='.0f', ax=ax)
+    ax.set_title('Activity Heatmap')
+    ax.set_xlabel('Hour of Day')
+    ax.set_ylabel('Day of Week')
+    return fig
+
+
+def busy_users_chart(busy_users):
+    fig, ax = _subplots(figsize=(10, 11))
+    sns.barplot(x=busy_users.index, y=busy_users.values, palette="viridis", ax=ax)
+    ax.set(xlabel=None)
+    return fig
+
+
+def wordcloud_chart(wordcloud_image):
+    fig, ax = _subplots()
+    ax.imshow(wordcloud_image, interpolation='bilinear')
+    ax.axis('off')
+    return fig
+
+
+def common_words_chart(most_common_df):
+    fig, ax = _subplots(figsize=(10, 6))
+    sns.barplot(x='Frequency', y='Word', data=most_common_df, palette="rocket", ax=ax)
+    return fig
+
+
+def emoji_chart(emoji_df):
+    fig, ax = _subplots()
+    ax.pie(emoji_df['Count'].head(), labels=emoji_df['Emoji'].head(), autopct="%0.2f")
+    return fig
+
+
+def peak_hours_chart(peak_hours):
+    fig, ax = _subplots()
+    peak_hours.plot(kind='bar', ax=ax)
+    ax.set_title('Peak Activity Hours')
+    ax.set_xlabel('Hour of Day')
+    ax.set_ylabel('Number of Messages')
+    return fig
+
+
+def sentiment_chart(sentiment_stats):
+    fig, ax = _subplots(figsize=(8, 8))
+    c = ["#DAD7CD", "#A3B18A", "#588157"]
+    sentiment_data = pd.Series(sentiment_stats)
+    ax.pie(sentiment_data, labels=sentiment_data.index, autopct='%1.1f%%', colors=c)
+    ax.set_title('Message Sentiment Distribution')
+    return fig
+
+
+def interactions_chart(user_interactions):
+    fig, ax = _subplots(figsize=(10, 6))
+    interaction_df = pd.DataFrame(list(user_interactions.items()), columns=['Interaction', 'Count'])
+    sns.barplot(data=interaction_df, x='Count', y='Interaction', ax=ax, palette="rocket")
+    ax.set_title('Top User Interactions')
+    return fig
+
+
+def reply_matrix_chart(reply_probabilities):
+    fig, ax = _subplots(figsize=(10, 8))
+    sns.heatmap(reply_probabilities, cmap='Greens', annot=len(reply_probabilities) <= 10, fmt='.2f', ax=ax)
+    ax.set_title('Who Replies to Whom')
+    ax.set_xlabel('Replied by')
+    ax.set_ylabel('Message by')
+    return fig
+
+
+charts = {
+    'timing': timing_chart,
+    'topics': topics_chart,
+    'timeline': timeline_chart,
+    'busy_day': busy_day_chart,
+    'busy_month': busy_month_chart,
+    'heatmap': heatmap_chart,
+    'busy_users': busy_users_chart,
+    'wordcloud': wordcloud_chart,
+    'common_words': common_words_chart,
+    'emoji': emoji_chart,
+    'peak_hours': peak_hours_chart,
+    'sentiment': sentiment_chart,
+    'interactions': interactions_chart,
+    'reply_matrix': reply_matrix_chart
+}
+
+
+def render_png(chart, data):
+    """Render one chart to PNG bytes"""
+    fig = charts[chart](data)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+
+def _get_executor():
+    global _executor
+    # Charts of several analysis jobs may be rendered at once
+    with _executor_lock:
+        if _executor is None:
+            # Spawned workers don't inherit the server's threads or open figures
+            _executor = ProcessPoolExecutor(max_workers=render_processes,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+@profiling.stage()
+def render_charts(chat_key, selected_user, chart_data):
+    """Render charts concurrently, reusing images cached by (chat, user, chart).
+
+    ``chart_data`` maps chart names to the data they are drawn from, or to a
+    function returning it, which is only called when the image is not cached.
+    The returned dict maps the same names to PNG bytes; charts whose data is
+    None have nothing to draw and are left out.
+    """
+    images = {}
+    missing = {}
+    for chart, data in chart_data.items():
+        image = _image_cache.get((chat_key, selected_user, chart))
+        if image is not None:
+            images[chart] = image
+            continue
+        data = data() if callable(data) else data
+        if data is not None:
+            missing[chart] = data
+
+    if render_processes > 1 and len(missing) > 1:
+        futures = {chart: _get_executor().submit(render_png, chart, data) for chart, data in missing.items()}
+        rendered = {chart: future.result() for chart, future in futures.items()}
+    else:
+        rendered = {chart: render_png(chart, data) for chart, data in missing.items()}
+
+    for chart, image in rendered.items():
+        _image_cache.put((chat_key, selected_user, chart), image)
+        images[chart] = image
+    return images
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from pandas.arrays import NumpyExtensionArray
+
+
+def content_hash(data):
+    """Hash of an upload's bytes (bytes or memoryview), used as its cache key"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _data_key(series):
+    # Identifies the memory behind a Series, which a column taken from a frame shares with the frame
+    array = series.array
+    if isinstance(array, NumpyExtensionArray):
+        data = array.to_numpy()
+        return ('ndarray', data.__array_interface__['data'][0], data.nbytes)
+    return ('array', id(array))
+
+
+def sizeof(value, _seen=None):
+    """Approximate memory held by a cached value, following containers and object attributes.
+
+    Data shared by several objects, such as a frame and a Series of one of
+    its columns, is counted once.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    if isinstance(value, pd.DataFrame):
+        return sizeof(value.index, _seen) + sum(sizeof(column, _seen) for _, column in value.items())
+    if isinstance(value, pd.Series):
+        key = _data_key(value)
+        if key in _seen:
+            return sizeof(value.index, _seen)
+        _seen.add(key)
+        return int(value.memory_usage(deep=True, index=False)) + sizeof(value.index, _seen)
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(item, _seen) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(item, _seen) for item in value)
+    if hasattr(value, '__dict__'):
+        return sizeof(vars(value), _seen)
+    return 0
+
+
+class ChatCache:
+    """Thread-safe LRU cache of parsed chats, bounded by a memory budget.
+
+    Entries are evicted least recently used first once their combined size
+    exceeds ``max_bytes``; the newest entry is always kept. Concurrent
+    requests for the same key wait for a single load instead of each
+    parsing the chat.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        size = sizeof(value)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self._evict()
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+
+            try:
+                value = loader()
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+            size = sizeof(value)
+
+            with self._lock:
+                self._entries[key] = value
+                self._sizes[key] = size
+                self._loading.pop(key, None)
+                self._evict()
+            return value
+
+    def refresh(self, key):
+        """Measure an entry again, for instance once its lazily computed parts are filled"""
+        with self._lock:
+            if key not in self._entries:
+                return
+            value = self._entries[key]
+        size = sizeof(value)
+        with self._lock:
+            if self._entries.get(key) is value:
+                self._sizes[key] = size
+                self._evict()
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            key, _ = self._entries.popitem(last=False)
+            total -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    @property
+    def size(self):
+        """Combined size in bytes of the cached entries"""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
@@ -0,0 +1,212 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+# SQLite database holding every stored chat
+store_path = os.path.join(os.path.expanduser('~'), '.cache', 'whatsapp_chat_analyzer', 'chats.sqlite')
+
+# Rows sent to the database per executemany call while a chat is ingested
+insert_batch = 50000
+
+# Frame columns stored per message, next to the chat id and the message's position in the chat
+message_columns = ['date', 'user', 'message', 'year', 'month_num', 'month', 'day_name', 'hour']
+
+_schema = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    name TEXT,
+    messages INTEGER,
+    added TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    user TEXT NOT NULL,
+    message TEXT,
+    year INTEGER,
+    month_num INTEGER,
+    month TEXT,
+    day_name TEXT,
+    hour INTEGER,
+    PRIMARY KEY (chat_id, position)
+);
+CREATE INDEX IF NOT EXISTS messages_chat_user_date ON messages (chat_id, user, date);
+CREATE INDEX IF NOT EXISTS messages_chat_date ON messages (chat_id, date);
+"""
+
+
+class ConnectionPool:
+    """Fixed number of SQLite connections shared by threads, one thread per connection at a time.
+
+    The database runs in WAL mode, so readers of any chat don't wait for a
+    chat being written.
+    """
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        """Close the idle connections"""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self._lock:
+                self._created -= 1
+
+
+def _rows(chat_id, df, start):
+    # Message rows of a slice of a parsed chat whose first message is number start
+    columns = {
+        'date': df['date'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'user': df['user'].astype(str),
+        'message': df['message'].astype(str),
+        'month': df['month'].astype(str),
+        'day_name': df['day_name'].astype(str),
+        'year': df['year'].astype('int64'),
+        'month_num': df['month_num'].astype('int64'),
+        'hour': df['hour'].astype('int64')
+    }
+    return zip([chat_id] * len(df), range(start, start + len(df)),
+               *(columns[column].tolist() for column in message_columns))
+
+
+def _where(chat_id, selected_user):
+    # chat_id None queries every stored chat; a list queries those chats
+    clauses, params = [], []
+    if isinstance(chat_id, (list, tuple)):
+        clauses.append(f"chat_id IN ({','.join('?' * len(chat_id))})")
+        params.extend(chat_id)
+    elif chat_id is not None:
+        clauses.append('chat_id = ?')
+        params.append(chat_id)
+    if selected_user != 'Overall':
+        clauses.append('user = ?')
+        params.append(selected_user)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+class ChatStore:
+    """Parsed chats kept in an SQLite database, queried with SQL instead of in memory.
+
+    Every chat is stored under a chat id (for instance the hash of its
+    export), so many chats, from many users of the app, share one database.
+    The aggregations return the same shapes as their helper counterparts
+    and take a chat id, a list of chat ids, or None for all stored chats.
+    Queries only read the chats they name, through the
+    (chat_id, user, date) index.
+    """
+
+    def __init__(self, path=None, pool_size=4):
+        path = path or store_path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.pool = ConnectionPool(path, pool_size)
+        with self.pool.connection() as connection:
+            connection.executescript(_schema)
+
+    def close(self):
+        self.pool.close()
+
+    def query(self, sql, params=()):
+        """Run any SELECT against the store and return the result as a DataFrame"""
+        with self.pool.connection() as connection:
+            return pd.read_sql_query(sql, connection, params=params)
+
+    def add_chat(self, chat_id, df, name=None):
+        """Store a parsed chat, replacing an earlier copy with the same id, in one transaction"""
+        insert = (f"INSERT INTO messages (chat_id, position, {', '.join(message_columns)}) "
+                  f"VALUES ({', '.join('?' * (len(message_columns) + 2))})")
+        with self.pool.connection() as connection, connection:
+            connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            for start in range(0, len(df), insert_batch):
+                connection.executemany(insert, _rows(chat_id, df.iloc[start:start + insert_batch], start))
+            connection.execute('INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?)',
+                               (chat_id, name, len(df), datetime.now().isoformat(timespec='seconds')))
+
+    def has_chat(self, chat_id):
+        with self.pool.connection() as connection:
+            return connection.execute('SELECT 1 FROM chats WHERE chat_id = ?', (chat_id,)).fetchone() is not None
+
+    def delete_chat(self, chat_id):
+        with self.pool.connection() as connection, connection:
+            connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            connection.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+
+    def chats(self):
+        """Stored chats with their name, number of messages and when they were added"""
+        return self.query('SELECT * FROM chats ORDER BY added')
+
+    def users(self, chat_id):
+        return self.query('SELECT DISTINCT user FROM messages WHERE chat_id = ? ORDER BY user',
+                          (chat_id,))['user'].tolist()
+
+    def monthly_timeline(self, selected_user, chat_id):
+        where, params = _where(chat_id, selected_user)
+        timeline = self.query(f"SELECT year, month_num, month, COUNT(*) AS message FROM messages{where} "
+                              f"GROUP BY year, month_num, month ORDER BY year, month_num", params)
+        timeline['time'] = timeline['month'].astype(str) + '-' + timeline['year'].astype(str)
+        return timeline
+
+    def activity_heatmap(self, selected_user, chat_id):
+        where, params = _where(chat_id, selected_user)
+        counts = self.query(f"SELECT day_name, hour, COUNT(*) AS count FROM messages{where} "
+                            f"GROUP BY day_name, hour", params)
+        return counts.set_index(['day_name', 'hour'])['count'].sort_index().unstack('hour').fillna(0)
+
+    def most_busy_users(self, chat_id):
+        where, params = _where(chat_id, 'Overall')
+        # Ties keep the order in which users first wrote, like value_counts
+        counts = self.query(f"SELECT user, COUNT(*) AS num_messages FROM messages{where} "
+                            f"GROUP BY user ORDER BY num_messages DESC, MIN(position)", params)
+        x = counts.set_index('user')['num_messages'].rename('count').head()
+        return x, counts
+
+    def get_peak_activity_hours(self, selected_user, chat_id):
+        where, params = _where(chat_id, selected_user)
+        peak_hours = self.query(f"SELECT hour, COUNT(*) AS message FROM messages{where} "
+                                f"GROUP BY hour ORDER BY message DESC, hour LIMIT 3", params)
+        return peak_hours.set_index('hour')['message']
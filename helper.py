@@ -1,11 +1,40 @@
 import pandas as pd
 import numpy as np
 import re
-from collections import Counter
-from wordcloud import WordCloud
+from functools import cached_property, lru_cache
+from wordcloud import WordCloud, STOPWORDS
 from urlextract import URLExtract
+import emoji
 import matplotlib.pyplot as plt
 import seaborn as sns
+import profiling
+
+# Characters fetch_stats splits words on, and the tokens it leaves out
+word_delimiters = r'`\-=~!@#$%^&*()_+\[\]{};\'\\:"|<,./<>? '
+word_pattern = re.compile(f'[^{word_delimiters}]+')
+media_word_pattern = re.compile(f'(?<![^{word_delimiters}])(?:media|omitted)(?![^{word_delimiters}])')
+
+# Tokens counted by most_common_words
+term_pattern = re.compile(r'\w+')
+
+# Words left out of the wordcloud on top of wordcloud's stopwords, and how many words it shows
+wordcloud_stopwords = set(STOPWORDS) | {'media', 'omitted'}
+wordcloud_max_words = 200
+
+# Cheap test for text that might hold a link: a scheme, www. or a dot before a TLD-like token.
+# TLDs can be non-ASCII, so any two non-space characters after the dot count.
+link_candidate_pattern = re.compile(r'://|www\.|\.[^\s.]{2}', re.IGNORECASE)
+
+# Time of day buckets of analyze_message_patterns (right-closed, so hour 0 falls in none of them)
+hour_bins = [0, 6, 12, 18, 24]
+hour_labels = ['Night', 'Morning', 'Afternoon', 'Evening']
+
+# Minutes of silence after which the next message starts a new conversation
+session_gap = 60
+
+# Runs of text that may hold emojis: non-ASCII characters, with the ASCII base of a keycap emoji in front
+emoji_run_pattern = re.compile(r'[#*0-9]?[^\x00-\x7f]+')
+
 
 def create_pattern_visualizations(pattern_results, df):
     # Remove NaN values before creating pie chart
@@ -20,29 +49,190 @@ def create_pattern_visualizations(pattern_results, df):
     else:
         print("No valid sentiment data to visualize")
         
-def fetch_stats(selected_user, df):
+class ChatIndex:
+    """Per-user row positions and pre-aggregated count cubes, built once per chat.
+
+    Passing an index to the helpers replaces their per-call boolean filter on
+    ``df['user']`` with a positional take, and lets the timeline, activity map
+    and heatmap helpers answer from the cubes without touching the frame.
+    """
+
+    @profiling.stage('ChatIndex')
+    def __init__(self, df):
+        self.user_rows = df.groupby('user', observed=True, sort=False).indices
+        self.month_counts = df.groupby(['user', 'year', 'month_num', 'month'], observed=True).size()
+        self.day_hour_counts = df.groupby(['user', 'day_name', 'hour'], observed=True).size()
+        self.hour_counts = self.day_hour_counts.groupby(level=['user', 'hour'], observed=True).sum()
+        self.word_counts = count_words(df['message'])
+        self.term_counts = term_frequencies(df)
+        self.link_counts = count_links(df['message'])
+        self.emoji_terms, self.emoji_counts = emoji_frequencies(df)
+        self.session_ids = assign_sessions(df['date'])
+        self.sessions = session_table(df, self.session_ids)
+        self.transitions = transition_matrix(df['user'])
+        self.feature_totals = feature_totals(message_features(df), df['user'])
+        self._messages = df['message']
+        self._users = df['user']
+
+    @cached_property
+    def sentiment(self):
+        """Polarity score of every message, computed on first use"""
+        return sentiment.get_sentiment_scores(self._messages)
+
+    @cached_property
+    def sentiment_totals(self):
+        """Positive, neutral and negative message counts per user"""
+        return sentiment_totals(self.sentiment, self._users)
+
+    @cached_property
+    def topics(self):
+        """Topic cluster of every message and the cluster labels, computed on first use"""
+        return message_topics(self._messages, self.term_counts.index.unique(level='word'))
+
+    @cached_property
+    def topic_totals(self):
+        """Messages per user and topic cluster"""
+        clusters, labels = self.topics
+        return cluster_totals(clusters, self._users, len(labels))
+
+    def rows(self, selected_user):
+        """Row positions of the selected user's messages"""
+        return self.user_rows.get(selected_user, np.empty(0, dtype=np.intp))
+
+    def counts(self, cube, selected_user, levels):
+        """Message counts from a cube for the selected user, grouped by levels"""
+        return cube_counts(cube, selected_user, levels)
+
+
+def cube_counts(cube, selected_user, levels):
+    """Sum a count cube indexed by user over the selected user's entries, grouped by levels"""
     if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
+        cube = cube[cube.index.get_level_values('user') == selected_user]
+    return cube.groupby(level=levels, observed=True).sum()
+
+
+def filter_user(selected_user, df, index=None):
+    """Return the selected user's messages, using the index positions when given"""
+    if selected_user == 'Overall':
+        return df
+    if index is not None:
+        return df.take(index.rows(selected_user))
+    return df[df['user'] == selected_user]
+
+
+@profiling.stage()
+def count_words(messages):
+    """Number of words in each message, excluding the media placeholder words"""
+    lowered = messages.astype(str).str.lower()
+    return (lowered.str.count(word_pattern) - lowered.str.count(media_word_pattern)).to_numpy()
+
+
+@lru_cache(maxsize=None)
+def get_url_extractor():
+    """Shared URLExtract instance, so the TLD list is only loaded once"""
+    return URLExtract()
+
+
+@profiling.stage()
+def count_links(messages):
+    """Number of links in each message, running URLExtract only on candidate messages"""
+    messages = messages.astype(str)
+    link_counts = np.zeros(len(messages), dtype=np.int64)
+    candidates = np.flatnonzero(messages.str.contains(link_candidate_pattern).to_numpy())
+    if len(candidates):
+        extractor = get_url_extractor()
+        link_counts[candidates] = [len(extractor.find_urls(message))
+                                   for message in messages.iloc[candidates]]
+    return link_counts
+
+
+@profiling.stage()
+def term_frequencies(df):
+    """Per-user word counts, with the position where each word first appears for the user"""
+    words = pd.Series(df['message'].to_numpy()).str.findall(term_pattern).explode().dropna()
+    terms = pd.DataFrame({
+        'user': df['user'].to_numpy()[words.index],
+        'word': words.to_numpy(),
+        'position': words.index
+    })
+    return terms.groupby(['user', 'word'], sort=False, observed=True)['position'].agg(
+        count='size', first='min')
+
+
+@profiling.stage()
+def emoji_frequencies(df):
+    """Per-user emoji counts and the number of emojis in each message, from one pass over the messages.
+
+    Emojis are whole grapheme clusters as the emoji package reads them, so
+    skin tones, ZWJ sequences, flags and keycaps count as one emoji and
+    repeated emojis count separately. Only messages with non-ASCII text are
+    scanned, and each distinct run of such text is tokenized once.
+    """
+    messages = df['message'].astype(str)
+    candidates = np.flatnonzero(messages.str.contains(r'[^\x00-\x7f]').to_numpy())
+    runs = messages.iloc[candidates].str.findall(emoji_run_pattern)
+    runs.index = candidates
+    runs = runs.explode().dropna()
+
+    run_codes, unique_runs = pd.factorize(runs)
+    run_emojis = pd.DataFrame([(code, match['emoji']) for code, run in enumerate(unique_runs)
+                               for match in emoji.emoji_list(run)], columns=['code', 'emoji'])
+    found = pd.DataFrame({'position': runs.index.to_numpy(dtype=np.int64), 'code': run_codes}).merge(
+        run_emojis, on='code')
+
+    emoji_counts = np.bincount(found['position'], minlength=len(df))
+    emojis = pd.DataFrame({
+        'user': df['user'].to_numpy()[found['position'].to_numpy()],
+        'emoji': found['emoji'].to_numpy(),
+        'position': found['position'].to_numpy()
+    })
+    emoji_terms = emojis.groupby(['user', 'emoji'], sort=False, observed=True)['position'].agg(
+        count='size', first='min')
+    return emoji_terms, emoji_counts
+
+
+def top_terms(terms, selected_user, n=10):
+    """Most frequent words (or emojis) for the selected user from a term_frequencies table"""
+    if selected_user != 'Overall':
+        terms = terms[terms.index.get_level_values('user') == selected_user]
+    terms = terms.groupby(level=-1, sort=False).agg({'count': 'sum', 'first': 'min'})
+    terms = terms.sort_values(['count', 'first'], ascending=[False, True])
+    return terms['count'].head(n)
+
+
+@profiling.stage()
+def fetch_stats(selected_user, df, index=None):
+    df = filter_user(selected_user, df, index)
 
     # Total Messages
     num_messages = df.shape[0]
 
     # Total Words (excluding media and links)
-    words = []
-    for msg in df['message'].apply(lambda x: str(x).lower()):
-        ms = re.split(r'[`\-=~!@#$%^&*()_+\[\]{};\'\\:"|<,./<>? ]', msg)
-        for word in ms:
-            if word and word != 'media' and word != 'omitted':
-                words.append(word)
+    if index is None:
+        num_words = count_words(df['message']).sum()
+    elif selected_user == 'Overall':
+        num_words = index.word_counts.sum()
+    else:
+        num_words = index.word_counts[index.rows(selected_user)].sum()
 
     # Media Messages
     media_count = df['message'].str.contains('<media omitted>', case=False).sum()
 
     # Links
-    extractor = URLExtract()
-    links = []
-    for message in df['message']:
-        links.extend(extractor.find_urls(str(message)))
+    if index is None:
+        num_links = count_links(df['message']).sum()
+    elif selected_user == 'Overall':
+        num_links = index.link_counts.sum()
+    else:
+        num_links = index.link_counts[index.rows(selected_user)].sum()
+
+    # Emojis
+    if index is None:
+        num_emojis = emoji_frequencies(df)[1].sum()
+    elif selected_user == 'Overall':
+        num_emojis = index.emoji_counts.sum()
+    else:
+        num_emojis = index.emoji_counts[index.rows(selected_user)].sum()
 
     # Missed Calls
     missed_calls = df['message'].str.contains('missed .* call', case=False, regex=True).sum()
@@ -57,9 +247,10 @@ def fetch_stats(selected_user, df):
 
     return {
         'num_messages': num_messages,
-        'num_words': len(words),
+        'num_words': num_words,
         'num_media': media_count,
-        'num_links': len(links),
+        'num_links': num_links,
+        'num_emojis': num_emojis,
         'missed_calls': missed_calls,
         'total_members': total_members,
         'chat_from': chat_from,
@@ -67,114 +258,313 @@ def fetch_stats(selected_user, df):
     }
 
 
-def get_chat_patterns(df):
-    # Group by date to find who starts and ends chats
-    date_groups = df.groupby('date')
+def count_values(series):
+    """value_counts that leaves out unused categories of categorical (compact) columns"""
+    counts = series.value_counts()
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        counts = counts[counts > 0]
+        counts.index = counts.index.astype(series.cat.categories.dtype)
+    return counts
+
 
-    chat_started_by = date_groups.first()['user'].value_counts().reset_index()
+@profiling.stage()
+def assign_sessions(dates, gap=None):
+    """Conversation number of every message, counting up in time order.
+
+    A conversation ends when nobody writes for more than ``gap`` minutes
+    (default: the module's ``session_gap``).
+    """
+    gap = session_gap if gap is None else gap
+    dates = dates.to_numpy()
+    order = np.argsort(dates, kind='stable')
+    new_session = np.diff(dates[order]) > np.timedelta64(int(gap * 60), 's')
+
+    session_ids = np.empty(len(dates), dtype=np.int64)
+    session_ids[order] = np.concatenate([[0], np.cumsum(new_session)])[:len(dates)]
+    return session_ids
+
+
+@profiling.stage()
+def session_table(df, session_ids):
+    """One row per conversation: when it started and ended, its size, who started and ended it"""
+    messages = pd.DataFrame({'session_id': session_ids, 'date': df['date'].to_numpy(), 'user': df['user'].to_numpy()})
+    messages = messages.iloc[np.argsort(messages['date'].to_numpy(), kind='stable')]
+    sessions = messages.groupby('session_id').agg(
+        start=('date', 'first'), end=('date', 'last'), messages=('user', 'size'),
+        started_by=('user', 'first'), ended_by=('user', 'last'), members=('user', 'nunique'))
+    sessions['minutes'] = (sessions['end'] - sessions['start']).dt.total_seconds() / 60
+    return sessions
+
+
+def _sessions(df, index, gap):
+    # The index holds the conversations for the default gap; any other gap splits them again
+    if index is not None and gap is None:
+        return index.session_ids, index.sessions
+    session_ids = assign_sessions(df['date'], gap)
+    return session_ids, session_table(df, session_ids)
+
+
+@profiling.stage()
+def get_chat_patterns(df, index=None, gap=None):
+    """Who starts and who ends conversations, as Member/Count tables"""
+    _, sessions = _sessions(df, index, gap)
+
+    chat_started_by = count_values(sessions['started_by']).reset_index()
     chat_started_by.columns = ['Member', 'Count']
 
-    chat_ended_by = date_groups.last()['user'].value_counts().reset_index()
+    chat_ended_by = count_values(sessions['ended_by']).reset_index()
     chat_ended_by.columns = ['Member', 'Count']
 
     return chat_started_by, chat_ended_by
 
 
-def monthly_timeline(selected_user, df):
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
+@profiling.stage()
+def get_session_stats(df, index=None, gap=None):
+    """Conversation sizes and how every member takes part in conversations.
+
+    Returns a dict with the number of conversations and their average and
+    median size in messages and minutes, and a table with, per member, the
+    conversations they wrote in, started and ended, and the share of all
+    conversations they took part in.
+    """
+    session_ids, sessions = _sessions(df, index, gap)
+    summary = {
+        'num_sessions': len(sessions),
+        'avg_messages': sessions['messages'].mean() if len(sessions) else 0,
+        'median_messages': sessions['messages'].median() if len(sessions) else 0,
+        'avg_minutes': sessions['minutes'].mean() if len(sessions) else 0,
+        'median_minutes': sessions['minutes'].median() if len(sessions) else 0
+    }
 
-    timeline = df.groupby(['year', 'month_num', 'month']).count()['message'].reset_index()
-    timeline['time'] = timeline['month'] + '-' + timeline['year'].astype(str)
+    pairs = pd.DataFrame({'user': df['user'].to_numpy(), 'session_id': session_ids}).drop_duplicates()
+    participation = pd.DataFrame({
+        'Sessions': count_values(pairs['user']),
+        'Started': count_values(sessions['started_by']),
+        'Ended': count_values(sessions['ended_by'])
+    }).fillna(0).astype(np.int64)
+    participation['Share'] = participation['Sessions'] / max(len(sessions), 1)
+    participation = participation.sort_values('Sessions', ascending=False, kind='stable')
+    return summary, participation.rename_axis('Member').reset_index()
+
+
+@profiling.stage()
+def monthly_timeline(selected_user, df, index=None):
+    if index is not None:
+        timeline = index.counts(index.month_counts, selected_user, ['year', 'month_num', 'month'])
+        timeline = timeline.rename('message').reset_index()
+        timeline['time'] = timeline['month'].astype(str) + '-' + timeline['year'].astype(str)
+        return timeline
+
+    df = filter_user(selected_user, df)
+
+    timeline = df.groupby(['year', 'month_num', 'month'], observed=True).count()['message'].reset_index()
+    timeline['time'] = timeline['month'].astype(str) + '-' + timeline['year'].astype(str)
     return timeline
 
 
-def week_activity_map(selected_user, df):
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
+@profiling.stage()
+def week_activity_map(selected_user, df, index=None):
+    if index is not None:
+        busy_day = index.counts(index.day_hour_counts, selected_user, 'day_name')
+        return busy_day.sort_values(ascending=False).rename('count')
 
-    return df['day_name'].value_counts()
+    df = filter_user(selected_user, df)
 
+    return count_values(df['day_name'])
 
-def month_activity_map(selected_user, df):
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
 
-    return df['month'].value_counts()
+@profiling.stage()
+def month_activity_map(selected_user, df, index=None):
+    if index is not None:
+        busy_month = index.counts(index.month_counts, selected_user, 'month')
+        return busy_month.sort_values(ascending=False).rename('count')
 
+    df = filter_user(selected_user, df)
+
+    return count_values(df['month'])
 
-def activity_heatmap(selected_user, df):
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
 
-    user_heatmap = df.pivot_table(index='day_name', columns='hour', values='message', aggfunc='count').fillna(0)
+@profiling.stage()
+def activity_heatmap(selected_user, df, index=None):
+    if index is not None:
+        user_heatmap = index.counts(index.day_hour_counts, selected_user, ['day_name', 'hour'])
+        return user_heatmap.unstack('hour').fillna(0)
+
+    df = filter_user(selected_user, df)
+
+    # Counting rows rather than messages lets this run on a frame loaded with only these columns
+    user_heatmap = df.groupby(['day_name', 'hour'], observed=True).size().unstack('hour').fillna(0)
     return user_heatmap
 
 
+@profiling.stage()
 def most_busy_users(df):
-    x = df['user'].value_counts().head()
-    new_df = df['user'].value_counts().reset_index()
+    x = count_values(df['user']).head()
+    new_df = count_values(df['user']).reset_index()
     new_df.columns = ['user', 'num_messages']
     return x, new_df
 
 
-def create_wordcloud(selected_user, df):
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
-
-    wc = WordCloud(width=500, height=500, min_font_size=10, background_color='white').generate(' '.join(df['message']))
-    return wc
-
+def wordcloud_frequencies(terms, selected_user, max_words=wordcloud_max_words):
+    """Top word frequencies for the wordcloud from a term_frequencies table.
 
-def most_common_words(selected_user, df):
+    Like WordCloud.generate, stopwords and numbers are dropped and case
+    variants are merged under their most common spelling.
+    """
     if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
+        terms = terms[terms.index.get_level_values('user') == selected_user]
+    counts = terms['count'].groupby(level='word', sort=False).sum()
+    words = pd.DataFrame({'word': counts.index.astype(str), 'count': counts.to_numpy()})
+    words['lower'] = words['word'].str.lower()
+    words = words[~words['lower'].isin(wordcloud_stopwords) & ~words['word'].str.isdigit()]
+
+    words = words.sort_values('count', ascending=False, kind='stable')
+    merged = words.groupby('lower', sort=False).agg({'word': 'first', 'count': 'sum'})
+    merged = merged.nlargest(max_words, 'count')
+    return dict(zip(merged['word'], merged['count']))
+
+
+@profiling.stage()
+def create_wordcloud(selected_user, df, index=None, width=500, height=500):
+    if index is not None:
+        terms = index.term_counts
+    else:
+        terms = term_frequencies(filter_user(selected_user, df))
 
-    words = ' '.join(df['message'])
-    words = re.findall(r'\w+', words)
-    most_common = Counter(words).most_common(10)
-    return pd.DataFrame(most_common, columns=['Word', 'Frequency'])
+    # A member who only sent media or stopwords has nothing to draw
+    frequencies = wordcloud_frequencies(terms, selected_user)
+    if not frequencies:
+        return None
+    wc = WordCloud(width=width, height=height, min_font_size=10, background_color='white')
+    return wc.generate_from_frequencies(frequencies)
 
 
-def emoji_helper(selected_user, df):
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
+@profiling.stage()
+def most_common_words(selected_user, df, index=None):
+    if index is not None:
+        terms = index.term_counts
+    else:
+        terms = term_frequencies(filter_user(selected_user, df))
 
-    emojis = df['message'].str.findall(
-        r'[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F700-\U0001F77F\U0001F900-\U0001F9FF\U0001F1E0-\U0001F1FF]+')
-    emojis = [item for sublist in emojis for item in sublist]
-    emoji_counts = Counter(emojis).most_common(10)
-    return pd.DataFrame(emoji_counts, columns=['Emoji', 'Count'])
+    most_common = top_terms(terms, selected_user)
+    return pd.DataFrame({'Word': most_common.index, 'Frequency': most_common.to_numpy()})
 
 
-def get_response_patterns(df):
-    """Analyze response patterns between users"""
+@profiling.stage()
+def emoji_helper(selected_user, df, index=None):
+    if index is not None:
+        emoji_terms = index.emoji_terms
+    else:
+        emoji_terms = emoji_frequencies(filter_user(selected_user, df))[0]
+
+    emoji_counts = top_terms(emoji_terms, selected_user)
+    return pd.DataFrame({'Emoji': emoji_counts.index, 'Count': emoji_counts.to_numpy()})
+
+
+@profiling.stage()
+def transition_matrix(users):
+    """Reply counts between users: entry [a, b] counts the messages by b that directly follow one by a.
+
+    Users are encoded as integer codes and every pair of consecutive
+    messages from different users is counted with one bincount.
+    """
+    codes, uniques = pd.factorize(users, sort=True)
+    uniques = pd.Index(np.asarray(uniques, dtype=object), name='user')
+    previous, following = codes[:-1], codes[1:]
+    is_reply = previous != following
+
+    n = len(uniques)
+    counts = np.bincount(previous[is_reply] * n + following[is_reply], minlength=n * n).reshape(n, n)
+    return pd.DataFrame(counts, index=uniques, columns=uniques.rename('replied_by'))
+
+
+def user_transitions(transitions, selected_user):
+    """The part of a transition matrix with the replies the selected user sent or received"""
+    if selected_user == 'Overall':
+        return transitions
+    involved = (transitions.index == selected_user)[:, None] | (transitions.columns == selected_user)[None, :]
+    return transitions.where(involved, 0)
+
+
+def top_transitions(transitions, k=5):
+    """The k most frequent reply pairs as a {'from->to': count} dict, most frequent first"""
+    counts = transitions.to_numpy().ravel()
+    k = min(k, np.count_nonzero(counts))
+    if k == 0:
+        return {}
+    top = np.argpartition(-counts, k - 1)[:k]
+    top = top[np.lexsort((top, -counts[top]))]
+    n = len(transitions.columns)
+    return {f"{transitions.index[i // n]}->{transitions.columns[i % n]}": int(counts[i]) for i in top}
+
+
+def interaction_degrees(transitions):
+    """Per user: replies received and sent (weighted degree) and the number of distinct partners of each"""
+    counts = transitions.to_numpy()
+    return pd.DataFrame({
+        'replies_received': counts.sum(axis=1),
+        'replies_sent': counts.sum(axis=0),
+        'repliers': np.count_nonzero(counts, axis=1),
+        'replied_to': np.count_nonzero(counts, axis=0)
+    }, index=transitions.index)
+
+
+def markov_matrix(transitions):
+    """Probability of who replies next given who wrote last; rows without replies stay zero"""
+    counts = transitions.to_numpy().astype(np.float64)
+    totals = counts.sum(axis=1, keepdims=True)
+    probabilities = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+    return pd.DataFrame(probabilities, index=transitions.index, columns=transitions.columns)
+
+
+def reply_probabilities(transitions, max_users=15):
+    """Markov matrix of the users with the most replies, for plotting"""
+    degrees = interaction_degrees(transitions)
+    active = (degrees['replies_received'] + degrees['replies_sent']).nlargest(max_users).index
+    return markov_matrix(transitions).loc[active, active]
+
+
+@profiling.stage()
+def get_response_patterns(df, max_gap=None):
+    """Analyze response patterns between users.
+
+    A response is a message whose previous message (in time order) came from
+    another user. Returns one row per (from_user, to_user) pair with the mean,
+    median and 90th percentile response time in minutes and the number of
+    responses. Responses slower than ``max_gap`` minutes are left out when
+    it is given, so overnight silences don't count as replies.
+    """
     # Sort messages by datetime
-    df_sorted = df.sort_values('date')
-
-    # Calculate time difference between messages
-    df_sorted['time_diff'] = df_sorted['date'].diff()
-
-    # Get response times between users
-    response_times = []
-    prev_user = None
-
-    for idx, row in df_sorted.iterrows():
-        if prev_user and prev_user != row['user']:
-            response_times.append({
-                'from_user': prev_user,
-                'to_user': row['user'],
-                'response_time': row['time_diff'].total_seconds() / 60  # Convert to minutes
-            })
-        prev_user = row['user']
-
-    return pd.DataFrame(response_times)
-
-
-def get_peak_activity_hours(selected_user, df):
+    df_sorted = df[['date', 'user']].sort_values('date', kind='stable')
+
+    # Compare every message with the one before it
+    users = df_sorted['user']
+    prev_users = users.shift()
+    response_time = df_sorted['date'].diff().dt.total_seconds() / 60  # Convert to minutes
+
+    is_response = prev_users.notna() & (users != prev_users)
+    if max_gap is not None:
+        is_response &= response_time <= max_gap
+
+    responses = pd.DataFrame({
+        'from_user': prev_users[is_response],
+        'to_user': users[is_response],
+        'response_time': response_time[is_response]
+    })
+    grouped = responses.groupby(['from_user', 'to_user'], observed=True)['response_time']
+    patterns = grouped.agg(['mean', 'median', 'count'])
+    patterns.insert(2, 'p90', grouped.quantile(0.9))
+    return patterns.reset_index()
+
+
+@profiling.stage()
+def get_peak_activity_hours(selected_user, df, index=None):
     """Analyze peak activity hours"""
-    if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
+    if index is not None:
+        hourly_activity = index.counts(index.hour_counts, selected_user, 'hour')
+        return hourly_activity.nlargest(3).rename('message')
+
+    df = filter_user(selected_user, df)
 
     hourly_activity = df.groupby('hour')['message'].count()
     peak_hours = hourly_activity.nlargest(3)
@@ -184,69 +574,202 @@ def get_peak_activity_hours(selected_user, df):
 
 # Add these functions to helper.py
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from textblob import TextBlob
-from collections import defaultdict
-
-
-def analyze_message_patterns(df, selected_user='Overall'):
-    """Analyze message patterns including timing, length, and content clusters"""
+import scipy.sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.cluster import MiniBatchKMeans
+import sentiment
+
+# Number of topic clusters, hashed feature columns, and distinct texts vectorized at a time.
+# Memory is bounded by one chunk of features and the dense cluster centers.
+topic_clusters = 8
+topic_features = 2 ** 18
+topic_chunk_size = 50000
+topic_label_words = 3
+
+
+@lru_cache(maxsize=None)
+def get_topic_vectorizer():
+    """Stateless vectorizer shared by every chat and user, so nothing is refitted per call"""
+    return HashingVectorizer(n_features=topic_features, stop_words='english', alternate_sign=False)
+
+
+def _chunks(size, chunk_size):
+    return [slice(start, start + chunk_size) for start in range(0, size, chunk_size)]
+
+
+@profiling.stage()
+def cluster_messages(messages, n_clusters=None, chunk_size=None):
+    """Topic cluster of every message (-1 for media and messages without words) and the cluster centers.
+
+    Distinct texts are hashed chunk by chunk and fed to MiniBatchKMeans with
+    partial_fit, weighted by how often they occur, then assigned in a second
+    pass over the same chunks.
+    """
+    n_clusters = n_clusters or topic_clusters
+    chunk_size = chunk_size or topic_chunk_size
+    vectorizer = get_topic_vectorizer()
+
+    messages = messages.astype(str)
+    is_text = ~messages.str.contains('<media omitted>', case=False, regex=False).to_numpy()
+    codes, texts = pd.factorize(messages[is_text])
+    weights = np.bincount(codes, minlength=len(texts))
+
+    text_clusters = np.full(len(texts), -1, dtype=np.int16)
+    centers = None
+    if len(texts) >= n_clusters:
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=0, n_init=3)
+        # The first partial_fit seeds the centers, so it waits for at least n_clusters rows with words
+        pending, pending_rows = [], 0
+        for chunk in _chunks(len(texts), chunk_size):
+            features = vectorizer.transform(texts[chunk])
+            has_words = features.getnnz(axis=1) > 0
+            pending.append((features[has_words], weights[chunk][has_words]))
+            pending_rows += has_words.sum()
+            if pending_rows >= n_clusters or (hasattr(model, 'cluster_centers_') and pending_rows):
+                model.partial_fit(scipy.sparse.vstack([batch for batch, _ in pending]),
+                                  sample_weight=np.concatenate([batch_weights for _, batch_weights in pending]))
+                pending, pending_rows = [], 0
+
+        if hasattr(model, 'cluster_centers_'):
+            centers = model.cluster_centers_
+            for chunk in _chunks(len(texts), chunk_size):
+                features = vectorizer.transform(texts[chunk])
+                has_words = features.getnnz(axis=1) > 0
+                assigned = np.full(features.shape[0], -1, dtype=np.int16)
+                if has_words.any():
+                    assigned[has_words] = model.predict(features[has_words])
+                text_clusters[chunk] = assigned
+
+    clusters = np.full(len(messages), -1, dtype=np.int16)
+    clusters[is_text] = text_clusters[codes]
+    return clusters, centers
+
+
+def cluster_labels(centers, words, n=None):
+    """Label every cluster with the words weighing most in its center"""
+    n = n or topic_label_words
+    if centers is None:
+        return []
+    words = pd.unique(pd.Series(words, dtype=object).str.lower())
+    features = get_topic_vectorizer().transform(words)
+    # Stop words and one-letter words hash to no column
+    single = features.getnnz(axis=1) == 1
+    words, columns = words[single], features[single].indices
+
+    weights = centers[:, columns]
+    top = np.argsort(-weights, axis=1, kind='stable')[:, :n]
+    return [', '.join(words[order]) or f'Topic {i + 1}' for i, order in enumerate(top)]
+
+
+def message_topics(messages, words=None):
+    """Topic cluster of every message and a label for every cluster.
+
+    ``words`` is the vocabulary the labels are picked from; it defaults to
+    the words of the messages.
+    """
+    clusters, centers = cluster_messages(messages)
+    if words is None:
+        words = messages.astype(str).str.findall(term_pattern).explode().dropna().unique()
+    return clusters, cluster_labels(centers, words)
+
+
+def cluster_totals(clusters, users, n_clusters):
+    """Messages per user and topic cluster, one column per cluster"""
+    has_topic = clusters >= 0
+    totals = pd.crosstab(np.asarray(users)[has_topic], clusters[has_topic])
+    return totals.reindex(columns=range(n_clusters), fill_value=0)
+
+
+def topic_counts(counts, labels):
+    """Messages per topic cluster as a {label: count} dict, largest first"""
+    # Clusters whose labels coincide are shown as one topic
+    topics = pd.Series(counts, index=labels, dtype=np.int64).groupby(level=0, sort=False).sum()
+    topics = topics.sort_values(ascending=False, kind='stable')
+    return topics[topics > 0].to_dict()
+
+
+@profiling.stage()
+def message_features(df):
+    """Time of day bucket, length in characters and number of words of every message"""
+    return pd.DataFrame({
+        'hour_category': pd.cut(df['hour'].to_numpy(), bins=hour_bins, labels=hour_labels),
+        'message_length': df['message'].str.len().to_numpy(dtype=np.int64),
+        'word_count': df['message'].str.split().str.len().to_numpy(dtype=np.int64)
+    })
+
+
+def feature_totals(features, users):
+    """Per-user message count, total characters and words, and messages per time of day"""
+    users = pd.Series(np.asarray(users), name='user')
+    grouped = features.groupby(users, sort=False)
+    totals = grouped.agg(messages=('message_length', 'size'), message_length=('message_length', 'sum'),
+                         word_count=('word_count', 'sum'))
+    timing = features.groupby([users, features['hour_category']], sort=False, observed=False).size()
+    return totals.join(timing.unstack('hour_category').reindex(columns=hour_labels, fill_value=0))
+
+
+def sentiment_totals(polarity, users):
+    """Per-user numbers of positive, neutral and negative messages"""
+    return pd.DataFrame({
+        'positive': polarity > 0.2,
+        'neutral': (polarity >= -0.2) & (polarity <= 0.2),
+        'negative': polarity < -0.2
+    }).groupby(pd.Series(np.asarray(users), name='user'), sort=False).sum()
+
+
+def _totals_for(totals, selected_user):
+    # Column sums of per-user totals over the selected user, or over everybody
     if selected_user != 'Overall':
-        df = df[df['user'] == selected_user]
-
-    # Message timing patterns
-    df['hour_category'] = pd.cut(df['hour'],
-                                 bins=[0, 6, 12, 18, 24],
-                                 labels=['Night', 'Morning', 'Afternoon', 'Evening'])
-
-    # Message length analysis
-    df['message_length'] = df['message'].str.len()
-    df['word_count'] = df['message'].str.split().str.len()
-
-    # Basic statistics
-    timing_patterns = df['hour_category'].value_counts()
-    avg_message_length = df['message_length'].mean()
-    avg_words_per_message = df['word_count'].mean()
-
-    # Message content clustering
-    vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
-
-    # Filter out media messages and ensure messages are strings
-    text_messages = df[~df['message'].str.contains('<media omitted>', case=False, na=False)]['message'].astype(str)
-
-    if len(text_messages) > 10:  # Only cluster if we have enough messages
-        tfidf_matrix = vectorizer.fit_transform(text_messages)
-
-    # Sentiment analysis
-    def get_sentiment(text):
-        try:
-            return TextBlob(str(text)).sentiment.polarity
-        except:
-            return 0
-
-    df['sentiment'] = df['message'].apply(get_sentiment)
-
-    # User interaction patterns
-    user_interactions = defaultdict(int)
-    prev_user = None
-    for user in df['user']:
-        if prev_user and user != prev_user:
-            user_interactions[f"{prev_user}->{user}"] += 1
-        prev_user = user
+        totals = totals[totals.index == selected_user]
+    return totals.sum()
+
+
+@profiling.stage()
+def analyze_message_patterns(df, selected_user='Overall', index=None):
+    """Analyze message patterns including timing, length, and content clusters.
+
+    With an index every result is a sum over per-user totals built once per
+    chat, so a call neither copies nor changes ``df``. Without one, the
+    features of the selected user's messages are computed on the fly; ``df``
+    is still left untouched.
+    """
+    if index is not None:
+        transitions = index.transitions
+        features = index.feature_totals
+        sentiments = index.sentiment_totals
+        clusters, labels = index.topics
+        topics = index.topic_totals
+    else:
+        # Replies are read from the whole chat, before it is narrowed to the selected user
+        transitions = transition_matrix(df['user'])
+        df = filter_user(selected_user, df)
+        features = feature_totals(message_features(df), df['user'])
+        sentiments = sentiment_totals(sentiment.get_sentiment_scores(df['message']), df['user'])
+        clusters, labels = message_topics(df['message'])
+        topics = cluster_totals(clusters, df['user'], len(labels))
+
+    # Message timing patterns and length analysis
+    features = _totals_for(features, selected_user)
+    timing_patterns = features[hour_labels].sort_values(ascending=False, kind='stable')
+    messages = features['messages']
+    avg_message_length = features['message_length'] / messages if messages else np.nan
+    avg_words_per_message = features['word_count'] / messages if messages else np.nan
+
+    # Sentiment analysis, scored once per chat when an index is given
+    sentiments = _totals_for(sentiments, selected_user)
+
+    # User interaction patterns, restricted to the replies the selected user sent or received
+    transitions = user_transitions(transitions, selected_user)
 
     # Compile results
     results = {
         'timing_patterns': timing_patterns.to_dict(),
         'avg_message_length': avg_message_length,
         'avg_words_per_message': avg_words_per_message,
-        'sentiment_stats': {
-            'positive': (df['sentiment'] > 0.2).sum(),
-            'neutral': ((df['sentiment'] >= -0.2) & (df['sentiment'] <= 0.2)).sum(),
-            'negative': (df['sentiment'] < -0.2).sum()
-        },
-        'user_interactions': dict(sorted(user_interactions.items(), key=lambda x: x[1], reverse=True)[:5])
+        'topic_clusters': topic_counts(_totals_for(topics, selected_user).to_numpy(), labels),
+        'sentiment_stats': {label: sentiments.get(label, 0) for label in ('positive', 'neutral', 'negative')},
+        'user_interactions': top_transitions(transitions),
+        'transitions': transitions
     }
 
     return results
@@ -275,7 +798,7 @@ def create_pattern_visualizations(pattern_results, df):
     figs['sentiment'] = fig2
 
     # 3. User Interactions Heatmap
-    interaction_data = pd.Series(pattern_results['user_interactions'])
+    interaction_data = pd.Series(top_transitions(pattern_results['transitions']))
     if len(interaction_data) > 0:
         fig3, ax3 = plt.subplots(figsize=(10, 6))
         interaction_df = pd.DataFrame(list(interaction_data.items()),
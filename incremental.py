@@ -0,0 +1,236 @@
+import hashlib
+import io
+import itertools
+import os
+
+import pandas as pd
+
+import helper
+import preprocessor
+import sentiment
+
+# Where the per-chat aggregates are persisted
+store_dir = os.path.join(os.path.expanduser('~'), '.cache', 'whatsapp_chat_analyzer', 'chats')
+
+# Number of leading messages that identify a chat across exports
+fingerprint_messages = 20
+
+# How the per-user statistics are combined when aggregates are merged
+_user_stat_aggs = {
+    'messages': 'sum',
+    'words': 'sum',
+    'media': 'sum',
+    'links': 'sum',
+    'emojis': 'sum',
+    'missed_calls': 'sum',
+    'positive': 'sum',
+    'neutral': 'sum',
+    'negative': 'sum',
+    'first_date': 'min',
+    'last_date': 'max'
+}
+
+
+def _hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def chat_fingerprint(data, fmt=None):
+    """Identify a chat by its leading messages, which stay the same in every newer export"""
+    lines = preprocessor.iter_lines(io.StringIO(data))
+    rows = itertools.islice(preprocessor.iter_messages(lines, fmt), fingerprint_messages)
+    return _hash('\n'.join('\t'.join(row[:3]) for row in rows))
+
+
+def last_message_offset(data, fmt=None):
+    """Character offset of the line where the last message of data starts (0 if there is none)"""
+    line_pattern, _ = preprocessor.get_line_parser(fmt)
+    end = len(data)
+    while end > 0:
+        start = data.rfind('\n', 0, end) + 1
+        if line_pattern.match(data[start:end].strip()):
+            return start
+        end = start - 1
+    return 0
+
+
+class ChatHistory:
+    """Aggregates of every settled message of a chat, merged export after export.
+
+    The count cubes use the same layout as ChatIndex, so the timeline,
+    activity map, heatmap, peak hour, common word and emoji helpers accept a
+    history as their ``index`` argument.
+    """
+
+    def __init__(self, month_counts, day_hour_counts, term_counts, emoji_terms, user_stats, messages=0):
+        self.month_counts = month_counts
+        self.day_hour_counts = day_hour_counts
+        self.hour_counts = day_hour_counts.groupby(level=['user', 'hour'], observed=True).sum()
+        self.term_counts = term_counts
+        self.emoji_terms = emoji_terms
+        self.user_stats = user_stats
+        self.messages = messages
+        # Part of the export these aggregates cover, used to find it in a newer export
+        self.offset = 0
+        self.prefix_hash = _hash('')
+
+    @classmethod
+    def from_frame(cls, df, start=0, processes=None):
+        """Aggregate a parsed frame whose first message is message number start of the chat.
+
+        ``processes`` is passed on to sentiment scoring; 1 scores in the
+        calling process.
+        """
+        index = helper.ChatIndex(df)
+        term_counts = index.term_counts.copy()
+        term_counts['first'] += start
+        emoji_terms = index.emoji_terms.copy()
+        emoji_terms['first'] += start
+
+        polarity = sentiment.get_sentiment_scores(df['message'], processes=processes)
+        stats = pd.DataFrame({
+            'messages': 1,
+            'words': index.word_counts,
+            'media': df['message'].str.contains('<media omitted>', case=False).to_numpy(),
+            'links': index.link_counts,
+            'emojis': index.emoji_counts,
+            'missed_calls': df['message'].str.contains('missed .* call', case=False, regex=True).to_numpy(),
+            'positive': polarity > 0.2,
+            'neutral': (polarity >= -0.2) & (polarity <= 0.2),
+            'negative': polarity < -0.2,
+            'first_date': df['date'].to_numpy(),
+            'last_date': df['date'].to_numpy()
+        }, index=pd.Index(df['user'].astype(str).to_numpy(), name='user'))
+        user_stats = stats.groupby(level='user').agg(_user_stat_aggs)
+
+        return cls(index.month_counts, index.day_hour_counts, term_counts, emoji_terms, user_stats, len(df))
+
+    def merge(self, other):
+        """Combine with the aggregates of the messages that follow this history"""
+        def add(a, b):
+            combined = pd.concat([_plain_users(a), _plain_users(b)])
+            return combined.groupby(level=list(range(combined.index.nlevels)), sort=False).sum()
+
+        def add_terms(a, b):
+            combined = pd.concat([_plain_users(a), _plain_users(b)])
+            return combined.groupby(level=[0, 1], sort=False).agg({'count': 'sum', 'first': 'min'})
+
+        user_stats = pd.concat([self.user_stats, other.user_stats]).groupby(level='user').agg(_user_stat_aggs)
+
+        return ChatHistory(add(self.month_counts, other.month_counts),
+                           add(self.day_hour_counts, other.day_hour_counts),
+                           add_terms(self.term_counts, other.term_counts),
+                           add_terms(self.emoji_terms, other.emoji_terms),
+                           user_stats, self.messages + other.messages)
+
+    def counts(self, cube, selected_user, levels):
+        """Message counts from a cube for the selected user, grouped by levels"""
+        return helper.cube_counts(cube, selected_user, levels)
+
+    def _user_stats(self, selected_user):
+        if selected_user == 'Overall':
+            return self.user_stats
+        return self.user_stats[self.user_stats.index == selected_user]
+
+    def fetch_stats(self, selected_user):
+        """Same statistics as helper.fetch_stats, answered from the aggregates"""
+        stats = self._user_stats(selected_user)
+        return {
+            'num_messages': stats['messages'].sum(),
+            'num_words': stats['words'].sum(),
+            'num_media': stats['media'].sum(),
+            'num_links': stats['links'].sum(),
+            'num_emojis': stats['emojis'].sum(),
+            'missed_calls': stats['missed_calls'].sum(),
+            'total_members': len(stats),
+            'chat_from': stats['first_date'].min().strftime('%Y-%m-%d') if not stats.empty else "N/A",
+            'chat_to': stats['last_date'].max().strftime('%Y-%m-%d') if not stats.empty else "N/A"
+        }
+
+    def sentiment_stats(self, selected_user):
+        """Positive, neutral and negative message counts"""
+        stats = self._user_stats(selected_user)
+        return {label: stats[label].sum() for label in ('positive', 'neutral', 'negative')}
+
+
+def _plain_users(cube):
+    """Turn a categorical user level into plain strings so cubes from different exports concat cleanly"""
+    level = cube.index.names.index('user')
+    users = cube.index.levels[level]
+    if isinstance(users.dtype, pd.CategoricalDtype):
+        cube = cube.copy()
+        cube.index = cube.index.set_levels(users.astype(str), level=level)
+    return cube
+
+
+def _history_path(key, path):
+    return os.path.join(path, f'{key}.pkl')
+
+
+def load_history(key, path=None):
+    """Load the persisted aggregates of a chat, or None if it was never processed"""
+    path = path or store_dir
+    history_path = _history_path(key, path)
+    if not os.path.exists(history_path):
+        return None
+    history = pd.read_pickle(history_path)
+    # Aggregates saved before emojis were counted are rebuilt from the export
+    if not hasattr(history, 'emoji_terms'):
+        return None
+    return history
+
+
+def save_history(key, history, path=None):
+    path = path or store_dir
+    os.makedirs(path, exist_ok=True)
+    history_path = _history_path(key, path)
+    pd.to_pickle(history, history_path + '.tmp')
+    os.replace(history_path + '.tmp', history_path)
+
+
+def update_history(data, path=None, processes=None):
+    """Analyze an export, parsing only what is new since the last export of the same chat.
+
+    The chat is recognised by its leading messages. If the part of the
+    export covered by the stored aggregates is unchanged, only the text after
+    it is parsed and aggregated, so the cost scales with the new messages.
+    The last message is re-read on the next update, since a newer export may
+    still add lines to it, and is therefore not persisted.
+
+    ``processes`` is passed on to sentiment scoring; use 1 when the caller
+    already runs in a pool of worker processes.
+
+    batch.py --incremental is the entry point. The app parses every upload
+    in full, since its conversation, response and topic sections need every
+    message, not only the aggregates.
+
+    Returns the history of the whole export and the DataFrame of the newly
+    parsed messages.
+    """
+    path = path or store_dir
+    fmt = preprocessor.detect_format(itertools.islice(
+        preprocessor.iter_lines(io.StringIO(data)), preprocessor.detect_sample_lines))
+    key = chat_fingerprint(data, fmt)
+
+    history = load_history(key, path)
+    if history is None or len(data) < history.offset or _hash(data[:history.offset]) != history.prefix_hash:
+        history = ChatHistory.from_frame(preprocessor.build_frame([]))
+    start = history.offset
+
+    # Everything before the last message is settled and merged into the stored aggregates
+    tail = data[start:]
+    split = last_message_offset(tail, fmt)
+    settled = preprocessor.build_frame(preprocessor.parse_lines(tail[:split].split('\n'), fmt))
+    last = preprocessor.build_frame(preprocessor.parse_lines(tail[split:].split('\n'), fmt))
+
+    history = history.merge(ChatHistory.from_frame(settled, history.messages, processes))
+    history.offset = start + split
+    history.prefix_hash = _hash(data[:history.offset])
+    save_history(key, history, path)
+
+    full = history.merge(ChatHistory.from_frame(last, history.messages, processes))
+    df = pd.concat([settled, last], ignore_index=True) if not last.empty else settled
+    print(f"Parsed {len(df)} new messages, {full.messages} in total")
+
+    return full, df
+
@@ -0,0 +1,78 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+# Threads running analysis jobs; the heavy work inside them (pandas, sklearn, chart processes) mostly runs outside the GIL
+job_workers = min(4, os.cpu_count() or 1) + 2
+
+
+class JobManager:
+    """Runs analysis jobs in the background, sharing identical jobs between callers.
+
+    A job is identified by a key, such as (chat, user, section). Submitting a
+    key that is still queued or running returns the future of that job
+    instead of starting another one. Every submit counts as one caller
+    interested in the job and release() drops that interest; a job nobody
+    waits for any more is cancelled if it has not started yet.
+
+    When a profiler is active at submit time, the job records its stages in
+    a profiler of its own, available as ``future.recorder`` (None otherwise)
+    for the run that takes the result to merge into its profiler.
+    """
+
+    def __init__(self, workers=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers or job_workers, thread_name_prefix='analysis')
+        self._jobs = {}
+        # Reentrant, since cancelling a future runs its done callback on the spot
+        self._lock = threading.RLock()
+
+    def submit(self, key, function, *args):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                job['callers'] += 1
+                return job['future']
+            recorder = profiling.recorder()
+            future = self._executor.submit(contextvars.copy_context().run, _run, recorder, function, *args)
+            future.recorder = recorder
+            self._jobs[key] = {'future': future, 'callers': 1}
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return future
+
+    def _finished(self, key, future):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job['future'] is future:
+                del self._jobs[key]
+
+    def release(self, key):
+        """Drop one caller's interest in a job, cancelling it if nobody else waits and it hasn't started"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job['callers'] -= 1
+            if job['callers'] > 0:
+                return
+            # A cancelled job is unregistered by its done callback; a running job can't be stopped,
+            # so it stays shared until it finishes
+            job['future'].cancel()
+
+    def running(self):
+        """Number of jobs queued or running"""
+        with self._lock:
+            return len(self._jobs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(recorder, function, *args):
+    # The submitting run's profiler may be stopped before the job runs, so the job records into its own
+    if recorder is None:
+        return function(*args)
+    with recorder:
+        return function(*args)
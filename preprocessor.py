@@ -1,87 +1,341 @@
 import pandas as pd
+import codecs
+import itertools
 import re
+from pandas.api.types import union_categoricals
+import profiling
+
+# Regex patterns for multiple timestamp formats
+patterns = {
+    '12h_standard': r'(\d{2}/\d{2}/\d{2},\s\d{1,2}:\d{2}\s[APMapm]{2})\s-\s(.*?):\s?(.*)',
+    '12h_bracketed': r'\[(\d{2}/\d{2}/\d{2},\s\d{2}:\d{2}:\d{2}\s[APMapm]{2})\]\s(.*?):\s(.*)',
+    '12h_extended': r'(\d{2}/\d{2}/\d{4},\s\d{1,2}:\d{2}\s[APMapm]{2})\s-\s(.*?):\s?(.*)',
+
+    # 24-hour formats
+    '24h_standard': r'(\d{2}/\d{2}/\d{2},\s\d{1,2}:\d{2})\s-\s(.*?):\s?(.*)',
+    '24h_bracketed': r'\[(\d{2}/\d{2}/\d{2},\s\d{2}:\d{2}:\d{2})\]\s(.*?):\s(.*)',
+    '24h_extended': r'(\d{2}/\d{2}/\d{4},\s\d{1,2}:\d{2})\s-\s(.*?):\s?(.*)'
+}
+
+# Column dtypes used by the compact schema
+compact_dtypes = {
+    'user': 'category',
+    'month': 'category',
+    'day_name': 'category',
+    'year': 'int16',
+    'month_num': 'int8',
+    'day': 'int8',
+    'hour': 'int8',
+    'minute': 'int8'
+}
+
+# Number of non-empty lines inspected when detecting the export format
+detect_sample_lines = 50
+
+# Bytes read per chunk by the streaming reader
+default_chunk_size = 4 * 1024 * 1024
+
+# Datetime format for the timestamp captured by each pattern
+date_formats = {
+    '12h_standard': '%d/%m/%y, %I:%M %p',
+    '12h_bracketed': '%d/%m/%y, %I:%M:%S %p',
+    '12h_extended': '%d/%m/%Y, %I:%M %p',
+    '24h_standard': '%d/%m/%y, %H:%M',
+    '24h_bracketed': '%d/%m/%y, %H:%M:%S',
+    '24h_extended': '%d/%m/%Y, %H:%M'
+}
+
+# Same formats for month-first (US locale) exports
+month_first_formats = {name: fmt.replace('%d/%m', '%m/%d') for name, fmt in date_formats.items()}
+
+_compiled_patterns = {name: re.compile(pattern) for name, pattern in patterns.items()}
+_combined_patterns = {}
+
+
+def detect_format(lines, sample_lines=detect_sample_lines):
+    """Return the name of the first timestamp pattern found in the leading lines"""
+    checked = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        for name, pattern in _compiled_patterns.items():
+            if pattern.match(line):
+                return name
+        checked += 1
+        if checked >= sample_lines:
+            break
+    return None
+
+
+def get_line_parser(fmt=None):
+    """Build one compiled alternation of all patterns, with the detected format tried first.
+
+    The timestamp prefixes of the patterns are mutually exclusive, so the
+    branch order only affects speed, never which pattern a line matches.
+    Returns the compiled regex and the pattern names in branch order; the
+    matched branch is recovered from ``match.lastindex``.
+    """
+    if fmt not in _combined_patterns:
+        names = list(patterns)
+        if fmt in names:
+            names.remove(fmt)
+            names.insert(0, fmt)
+        combined = '|'.join(f'(?:{patterns[name]})' for name in names)
+        _combined_patterns[fmt] = (re.compile(combined), names)
+    return _combined_patterns[fmt]
+
+
+def iter_messages(lines, fmt=None):
+    """Yield [date_time, user, message, pattern_name] rows from raw export lines.
+
+    A row is only yielded once the next message starts (or the lines run
+    out), so continuation lines arriving later are still attached to it.
+    """
+    line_pattern, names = get_line_parser(fmt)
+    match_line = line_pattern.match
+
+    row = None
+    # Parts of the message currently being built; joined once it is complete
+    parts = None
 
-def preprocess(data):
-    # Split the data into lines
-    lines = data.split('\n')
-    
-    # Create a list to hold the processed messages
-    messages = []
-    
-    # Regex patterns for multiple timestamp formats
-    patterns = {
-        '12h_standard': r'(\d{2}/\d{2}/\d{2},\s\d{1,2}:\d{2}\s[APMapm]{2})\s-\s(.*?):\s?(.*)',
-        '12h_bracketed': r'\[(\d{2}/\d{2}/\d{2},\s\d{2}:\d{2}:\d{2}\s[APMapm]{2})\]\s(.*?):\s(.*)',
-        '12h_extended': r'(\d{2}/\d{2}/\d{4},\s\d{1,2}:\d{2}\s[APMapm]{2})\s-\s(.*?):\s?(.*)',
-        
-        # 24-hour formats
-        '24h_standard': r'(\d{2}/\d{2}/\d{2},\s\d{1,2}:\d{2})\s-\s(.*?):\s?(.*)',
-        '24h_bracketed': r'\[(\d{2}/\d{2}/\d{2},\s\d{2}:\d{2}:\d{2})\]\s(.*?):\s(.*)',
-        '24h_extended': r'(\d{2}/\d{2}/\d{4},\s\d{1,2}:\d{2})\s-\s(.*?):\s?(.*)'
-    }
-    
     for line in lines:
         line = line.strip()
         if not line:
             continue
-        
-        matched = False
-        for pattern in patterns.values():
-            match = re.match(pattern, line)
-            if match:
-                date_time, user, message = match.groups()
-                messages.append([date_time, user.strip(), message.strip()])
-                matched = True
-                break
-        
+
+        match = match_line(line)
+        if match:
+            if row is not None:
+                row[2] = '\n'.join(parts)
+                yield row
+            branch = (match.lastindex - 1) // 3
+            date_time, user, message = match.group(3 * branch + 1, 3 * branch + 2, 3 * branch + 3)
+            row = [date_time, user.strip(), None, names[branch]]
+            parts = [message.strip()]
+
         # Handle continued messages
-        if not matched and messages:
-            messages[-1][2] += '\n' + line.strip()
-    
+        elif parts is not None:
+            parts.append(line)
+
+    if row is not None:
+        row[2] = '\n'.join(parts)
+        yield row
+
+
+def parse_lines(lines, fmt=None):
+    """Parse raw export lines into a list of [date_time, user, message, pattern_name] rows"""
+    return list(iter_messages(lines, fmt))
+
+
+def iter_lines(fileobj, chunk_size=default_chunk_size, encoding='utf-8'):
+    """Read a file object in chunks and yield complete lines, decoding incrementally"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    tail = ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        lines = (tail + chunk).split('\n')
+        # The last piece may be a partial line; carry it into the next chunk
+        tail = lines.pop()
+        yield from lines
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+@profiling.stage()
+def build_frame(messages, malformed=None, compact=False):
+    """Create the analysis DataFrame from parsed message rows.
+
+    Rows whose timestamp cannot be converted are reported and, when a
+    ``malformed`` list is given, appended to it as [date_time, user, message].
+    With ``compact`` the frame uses the compact schema (see compact_frame).
+    """
     # Create DataFrame
-    df = pd.DataFrame(messages, columns=['date', 'user', 'message'])
-    
-    # Convert dates with multiple format attempts
-    date_formats = [
-        '%d/%m/%y, %I:%M %p',
-        '%d/%m/%y, %I:%M:%S %p',
-        '%d/%m/%Y, %I:%M %p',
-        '%d/%m/%y, %H:%M',
-        '%d/%m/%y, %H:%M:%S',
-        '%d/%m/%Y, %H:%M'
-    ]
-    
-    # Function to try multiple datetime conversions
-    def convert_datetime(date_series):
-        for fmt in date_formats:
-            try:
-                converted = pd.to_datetime(date_series, format=fmt)
-                if not converted.empty:
-                    return converted
-            except:
-                continue
-        return pd.to_datetime(date_series, errors='coerce')
-    
-    # Convert dates
-    df['date'] = convert_datetime(df['date'])
-    
-    # Handle potential conversion failures
-    df = df.dropna(subset=['date'])
+    df = pd.DataFrame(messages, columns=['date', 'user', 'message', 'pattern'])
+
+    # Convert dates with the format of the pattern each row matched, reading a group
+    # month-first when fewer of its rows fail that way; rows failing the chosen order
+    # are retried with the other one
+    def convert_group(rows, name):
+        day_first = pd.to_datetime(rows, format=date_formats[name], errors='coerce')
+        if not day_first.isna().any():
+            return day_first
+        month_first = pd.to_datetime(rows, format=month_first_formats[name], errors='coerce')
+        if month_first.isna().sum() < day_first.isna().sum():
+            return month_first.fillna(day_first)
+        return day_first.fillna(month_first)
+
+    def convert_datetime(date_series, pattern_series):
+        converted = [convert_group(rows, name)
+                     for name, rows in date_series.groupby(pattern_series, sort=False)]
+        if not converted:
+            return pd.to_datetime(date_series)
+        if len(converted) == 1:
+            return converted[0]
+        return pd.concat(converted).reindex(date_series.index)
+
+    dates = convert_datetime(df['date'], df['pattern'])
+
+    # Report rows whose timestamp matched a pattern but is not a valid date
+    invalid = dates.isna()
+    if invalid.any():
+        print(f"Skipped {invalid.sum()} messages with malformed timestamps")
+        if malformed is not None:
+            malformed.extend(df.loc[invalid, ['date', 'user', 'message']].values.tolist())
+
+    df['date'] = dates
+    df = df[~invalid].drop(columns='pattern')
     
-    # Extract datetime features safely
-    if not df.empty:
-        df['only_date'] = df['date'].dt.date
-        df['year'] = df['date'].dt.year
-        df['month'] = df['date'].dt.month_name()
-        df['month_num'] = df['date'].dt.month
-        df['day'] = df['date'].dt.day
-        df['day_name'] = df['date'].dt.day_name()
-        df['hour'] = df['date'].dt.hour
-        df['minute'] = df['date'].dt.minute
+    # Extract datetime features (also on an empty frame, so every frame has the same columns)
+    df['only_date'] = df['date'].dt.date
+    df['year'] = df['date'].dt.year
+    df['month'] = df['date'].dt.month_name()
+    df['month_num'] = df['date'].dt.month
+    df['day'] = df['date'].dt.day
+    df['day_name'] = df['date'].dt.day_name()
+    df['hour'] = df['date'].dt.hour
+    df['minute'] = df['date'].dt.minute
     
     # Optional: Handle media and system messages
     df['is_media'] = df['message'].str.contains('<Media omitted>', case=False)
+
+    if compact:
+        df = compact_frame(df)
+
+    return df
+
+
+def compact_frame(df):
+    """Return a copy of df using categoricals and small ints, without only_date.
+
+    ``only_date`` is dropped because it holds one Python object per row; use
+    get_only_date to derive it from ``date`` when it is needed.
+    """
+    df = df.drop(columns='only_date', errors='ignore')
+    dtypes = {column: dtype for column, dtype in compact_dtypes.items() if column in df.columns}
+    return df.astype(dtypes)
+
+
+def get_only_date(df):
+    """Return the calendar date of each message for standard and compact frames"""
+    if 'only_date' in df.columns:
+        return df['only_date']
+    return df['date'].dt.date
+
+
+def memory_report(df):
+    """Compare the per-column memory footprint of a standard frame and its compact form"""
+    report = pd.DataFrame({
+        'standard_bytes': df.memory_usage(index=False, deep=True),
+        'compact_bytes': compact_frame(df).memory_usage(index=False, deep=True)
+    }).fillna(0).astype('int64')
+    report.loc['total'] = report.sum()
+    report['saved_pct'] = (100 * (1 - report['compact_bytes'] / report['standard_bytes'])).round(1)
+    return report
+
+
+def save_frame(df, path):
+    """Write a parsed chat to an uncompressed Arrow IPC file that load_frame can memory-map.
+
+    The frame is stored in the compact schema, so user, month and day_name
+    are kept as dictionary-encoded columns.
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    table = pa.Table.from_pandas(compact_frame(df), preserve_index=False)
+    feather.write_feather(table, path, compression='uncompressed')
+
+
+@profiling.stage()
+def load_frame(path, columns=None, user=None):
+    """Load a chat written by save_frame as a compact frame.
+
+    The file is memory-mapped and only ``columns`` (default: all) are read;
+    with ``user`` only that user's messages are materialized. For example
+    ``load_frame(path, ['user', 'day_name', 'hour'], user='Alice')`` is all
+    activity_heatmap needs.
+    """
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+
+    dataset = ds.dataset(path, format='ipc', filesystem=fs.LocalFileSystem(use_mmap=True))
+    row_filter = ds.field('user') == user if user is not None else None
+    table = dataset.to_table(columns=columns, filter=row_filter)
+    return table.to_pandas()
+
+
+@profiling.stage()
+def preprocess(data, malformed=None, compact=False):
+    # Split the data into lines
+    lines = data.split('\n')
+
+    # Detect the export format once, then parse every line with one pattern
+    fmt = detect_format(lines)
+    df = build_frame(parse_lines(lines, fmt), malformed, compact)
     
     print(f"Total messages processed: {len(df)}")
     
-    return df
\ No newline at end of file
+    return df
+
+
+# Not a profiling stage: calling a generator returns before any parsing; build_frame times each chunk
+def preprocess_stream(fileobj, chunk_size=default_chunk_size, encoding='utf-8', malformed=None,
+                      compact=False):
+    """Parse a chat export from a file object, yielding DataFrame chunks.
+
+    The file is decoded incrementally and partial lines and multi-line
+    messages are carried across chunk boundaries, so peak memory is bounded
+    by ``chunk_size`` (roughly the text held per yielded chunk) rather than
+    by the size of the file.
+    """
+    lines = iter_lines(fileobj, chunk_size, encoding)
+
+    # Peek at the leading lines to detect the export format
+    head = list(itertools.islice(lines, detect_sample_lines))
+    fmt = detect_format(head)
+
+    messages = []
+    size = 0
+    for row in iter_messages(itertools.chain(head, lines), fmt):
+        messages.append(row)
+        size += len(row[2])
+        if size >= chunk_size:
+            df = build_frame(messages, malformed, compact)
+            if not df.empty:
+                yield df
+            messages = []
+            size = 0
+
+    if messages:
+        df = build_frame(messages, malformed, compact)
+        if not df.empty:
+            yield df
+
+
+@profiling.stage()
+def preprocess_file(fileobj, chunk_size=default_chunk_size, encoding='utf-8', malformed=None,
+                    compact=False):
+    """Parse a chat export from a file object into one DataFrame via preprocess_stream"""
+    chunks = list(preprocess_stream(fileobj, chunk_size, encoding, malformed, compact))
+    if not chunks:
+        return build_frame([], compact=compact)
+
+    if compact:
+        # Align categories across chunks so concat keeps the columns categorical
+        for column, dtype in compact_dtypes.items():
+            if dtype == 'category':
+                categories = union_categoricals([chunk[column] for chunk in chunks], sort_categories=True).categories
+                for chunk in chunks:
+                    chunk[column] = chunk[column].cat.set_categories(categories)
+
+    df = pd.concat(chunks, ignore_index=True)
+
+    print(f"Total messages processed: {len(df)}")
+
+    return df
@@ -0,0 +1,186 @@
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Profiler collecting stage timings for the current run (per thread/session), or None
+_active = contextvars.ContextVar('profiler', default=None)
+
+
+class Profiler:
+    """Collects wall time, row count and peak memory of every stage run while it is active.
+
+    ``memory`` traces allocations with tracemalloc and ``cprofile`` records a
+    cProfile of the run; both slow the run down, so they are off by default.
+    Stages may run in several threads; each thread nests its own stages, but
+    tracemalloc peaks are process wide, so stages that overlap in time share
+    their peak memory.
+    """
+
+    def __init__(self, memory=False, cprofile=False):
+        self.memory = memory
+        self.cprofile = cprofile
+        self.records = []
+        self._local = threading.local()
+        self._profile = None
+        self._started = None
+        self._tracing = False
+        self.total_seconds = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler per process; another run is capturing already
+                self._profile = None
+        _active.set(self)
+        return self
+
+    def stop(self):
+        if _active.get() is self:
+            _active.set(None)
+        if self._profile is not None:
+            self._profile.disable()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        if self._started is not None:
+            self.total_seconds = time.perf_counter() - self._started
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def _stack(self):
+        # Stages nest per thread
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _enter(self, name):
+        stack = self._stack
+        frame = {'stage': name, 'depth': len(stack), 'peak': 0, 'base': 0}
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['base'] = current
+        stack.append(frame)
+        frame['started'] = time.perf_counter()
+        return frame
+
+    def _exit(self, frame, rows):
+        seconds = time.perf_counter() - frame['started']
+        stack = self._stack
+        stack.pop()
+        peak_bytes = None
+        if self.memory and tracemalloc.is_tracing():
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            peak_bytes = peak - frame['base']
+        self.records.append({'stage': frame['stage'], 'depth': frame['depth'], 'seconds': seconds,
+                             'rows': rows, 'peak_bytes': peak_bytes})
+
+    def merge(self, other):
+        """Add the stages recorded by another profiler, such as the recorder of a background job"""
+        self.records.extend(other.records)
+
+    def to_frame(self):
+        """Stage records, one row per call in the order the calls finished"""
+        return pd.DataFrame(self.records, columns=['stage', 'depth', 'seconds', 'rows', 'peak_bytes'])
+
+    def summary(self):
+        """Total time, calls and largest peak memory per stage, slowest first"""
+        frame = self.to_frame()
+        summary = frame.groupby('stage').agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+                                             rows=('rows', 'max'), peak_bytes=('peak_bytes', 'max'))
+        return summary.sort_values('seconds', ascending=False).reset_index()
+
+    def cprofile_stats(self, limit=30):
+        """Top functions by cumulative time from the cProfile capture, as text"""
+        if self._profile is None:
+            return ''
+        output = io.StringIO()
+        pstats.Stats(self._profile, stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def to_json(self):
+        return json.dumps({
+            'total_seconds': self.total_seconds,
+            'stages': self.records,
+            'cprofile': self.cprofile_stats() or None
+        }, indent=2)
+
+
+def activate(profiler):
+    """Make profiler (or None, turning profiling off) the active one for the current run"""
+    if profiler is None:
+        _active.set(None)
+        return None
+    return profiler.start()
+
+
+def recorder():
+    """New profiler recording stages like the active one, or None when profiling is off.
+
+    Work handed to another thread records its stages there; the run that
+    waits for the work merges them into its own profiler. The recorder never
+    captures a cProfile: from Python 3.12 only one can be enabled per
+    process, and the active profiler holds it.
+    """
+    profiler = _active.get()
+    if profiler is None:
+        return None
+    return Profiler(memory=profiler.memory)
+
+
+def _count_rows(args, result):
+    for value in args + (result,):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return len(value)
+    return None
+
+
+def stage(name=None):
+    """Decorator recording each call of a function as a stage of the active profiler.
+
+    When no profiler is active the call goes straight through, so
+    instrumented functions cost one context variable lookup.
+    """
+    def decorator(function):
+        stage_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active.get()
+            if profiler is None:
+                return function(*args, **kwargs)
+
+            frame = profiler._enter(stage_name)
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                profiler._exit(frame, _count_rows(args, result))
+        return wrapper
+    return decorator
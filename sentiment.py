@@ -0,0 +1,110 @@
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from textblob import TextBlob
+import profiling
+
+# On-disk cache of polarity scores keyed by a hash of the message text
+cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'whatsapp_chat_analyzer', 'sentiment.sqlite')
+
+# Texts scored per worker task, and the fewest uncached texts worth starting a process pool for
+batch_size = 2000
+min_parallel_texts = 5000
+
+# SQLite limits the number of parameters in one query
+_query_batch = 900
+
+# Default of get_sentiment_scores' path, standing for cache_path as it is when called
+_default_path = object()
+
+
+def get_sentiment(text):
+    """Polarity of one message, 0 when TextBlob cannot score it"""
+    try:
+        return TextBlob(str(text)).sentiment.polarity
+    except:
+        return 0
+
+
+def _score_batch(texts):
+    return [get_sentiment(text) for text in texts]
+
+
+def score_texts(texts, processes=None):
+    """Score texts, spreading large inputs over a process pool in batches"""
+    if len(texts) < min_parallel_texts or processes == 1:
+        return _score_batch(texts)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    # Scoring runs from threads of the app's server, which forked workers would inherit mid-flight
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        scores = []
+        for batch_scores in executor.map(_score_batch, batches):
+            scores.extend(batch_scores)
+    return scores
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _connect(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('CREATE TABLE IF NOT EXISTS sentiment (hash TEXT PRIMARY KEY, polarity REAL)')
+    return connection
+
+
+def _load_cached(connection, hashes):
+    cached = {}
+    for i in range(0, len(hashes), _query_batch):
+        batch = hashes[i:i + _query_batch]
+        query = f"SELECT hash, polarity FROM sentiment WHERE hash IN ({','.join('?' * len(batch))})"
+        cached.update(connection.execute(query, batch).fetchall())
+    return cached
+
+
+@profiling.stage()
+def get_sentiment_scores(messages, path=_default_path, processes=None):
+    """Polarity score for every message in a Series.
+
+    Each distinct text is scored once. Scores are looked up in and saved to
+    the SQLite cache at ``path`` (default: the module's ``cache_path``), so
+    scoring the same export again, or a newer export of the same chat, only
+    scores texts that were not seen before. ``path=None`` skips the cache
+    for one call; setting ``cache_path`` to None turns it off for all.
+    """
+    if path is _default_path:
+        path = cache_path
+    codes, uniques = pd.factorize(messages.astype(str))
+    texts = list(uniques)
+    scores = np.zeros(len(texts))
+    if not texts:
+        return scores[codes]
+
+    hashes = [text_hash(text) for text in texts]
+    connection = _connect(path) if path else None
+    try:
+        cached = _load_cached(connection, hashes) if connection else {}
+        missing = [i for i, key in enumerate(hashes) if key not in cached]
+        for i, key in enumerate(hashes):
+            if key in cached:
+                scores[i] = cached[key]
+
+        if missing:
+            new_scores = score_texts([texts[i] for i in missing], processes)
+            scores[missing] = new_scores
+            if connection:
+                with connection:
+                    connection.executemany('INSERT OR IGNORE INTO sentiment VALUES (?, ?)',
+                                           zip([hashes[i] for i in missing], new_scores))
+    finally:
+        if connection:
+            connection.close()
+
+    return scores[codes]
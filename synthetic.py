@@ -0,0 +1,104 @@
+"""Generate synthetic WhatsApp chat exports for benchmarking.
+
+Usage:
+    python synthetic.py OUTPUT.txt --lines 100000 [--format 12h_standard|...|mixed] [--users 8]
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+import preprocessor
+
+words = ('hello', 'ok', 'yes', 'no', 'see', 'you', 'tomorrow', 'lol', 'thanks', 'meeting', 'call', 'later',
+         'good', 'morning', 'night', 'where', 'are', 'what', 'time', 'home', 'work', 'great', 'sure', 'sorry',
+         'happy', 'birthday', 'party', 'food', 'movie', 'weekend', 'bad', 'love', 'this', 'that', 'plan')
+emojis = ('😂', '❤️', '👍', '🙏', '😭', '🔥', '🎉', '😊', '👍🏽', '👨‍👩‍👧', '🇮🇳', '🤦‍♂️')
+urls = ('https://example.com/page', 'www.example.org', 'http://news.example.net/a?b=1', 'example.co.uk')
+system_messages = ('Messages and calls are end-to-end encrypted.', 'Alice added Bob', 'You changed the group icon')
+
+
+def _timestamp_formats():
+    formats = {}
+    for name, date_format in preprocessor.date_formats.items():
+        if 'bracketed' in name:
+            formats[name] = '[' + date_format + '] '
+        else:
+            formats[name] = date_format + ' - '
+    return formats
+
+
+def generate_lines(num_lines, fmt='12h_standard', users=8, multiline_ratio=0.1, media_ratio=0.05,
+                   url_ratio=0.05, emoji_ratio=0.2, seed=0):
+    """Yield roughly num_lines lines of a synthetic export.
+
+    ``fmt`` is one of the timestamp patterns in preprocessor.patterns, or
+    'mixed' to pick one per message. The ratios are the share of messages
+    that span several lines, are media placeholders, contain a link or
+    contain emojis.
+    """
+    rng = random.Random(seed)
+    formats = _timestamp_formats()
+    names = list(formats) if fmt == 'mixed' else [fmt]
+    members = [f'User {i}' for i in range(users - 1)] + ['+91 98765 43210']
+
+    moment = datetime(2020, 1, 1, 8, 0, 0)
+    produced = 0
+    while produced < num_lines:
+        moment += timedelta(seconds=rng.randint(5, 3600))
+        prefix = moment.strftime(formats[rng.choice(names)])
+
+        if rng.random() < 0.002:
+            # System messages have no user and are read as continuation lines
+            yield prefix + rng.choice(system_messages)
+            produced += 1
+            continue
+
+        if rng.random() < media_ratio:
+            text = '<Media omitted>'
+        else:
+            text = ' '.join(rng.choices(words, k=rng.randint(1, 12)))
+            if rng.random() < url_ratio:
+                text += ' ' + rng.choice(urls)
+            if rng.random() < emoji_ratio:
+                text += ' ' + ''.join(rng.choices(emojis, k=rng.randint(1, 3)))
+        yield f'{prefix}{rng.choice(members)}: {text}'
+        produced += 1
+
+        if rng.random() < multiline_ratio:
+            for _ in range(rng.randint(1, 3)):
+                yield ' '.join(rng.choices(words, k=rng.randint(1, 8)))
+                produced += 1
+
+
+def generate_chat(num_lines, **options):
+    """Return a synthetic export as one string"""
+    return '\n'.join(generate_lines(num_lines, **options))
+
+
+def write_chat(path, num_lines, **options):
+    """Write a synthetic export to path, one line at a time"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for line in generate_lines(num_lines, **options):
+            f.write(line + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic WhatsApp chat export.')
+    parser.add_argument('output')
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--format', default='12h_standard', choices=list(preprocessor.patterns) + ['mixed'])
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--multiline-ratio', type=float, default=0.1)
+    parser.add_argument('--media-ratio', type=float, default=0.05)
+    parser.add_argument('--url-ratio', type=float, default=0.05)
+    parser.add_argument('--emoji-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    write_chat(args.output, args.lines, fmt=args.format, users=args.users,
+               multiline_ratio=args.multiline_ratio, media_ratio=args.media_ratio,
+               url_ratio=args.url_ratio, emoji_ratio=args.emoji_ratio, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()